@@ -0,0 +1,258 @@
+########################
+## Pipelined acquisition of the pattern positions: XRF spectrum + TXM image per position
+# device sessions are opened once, axes move concurrently, the TXM exposure runs while the
+# XRF spectrum integrates, and the end of the XRF run is polled instead of waited for
+########################
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.io
+
+
+class XradiaBackend:
+    '''
+        The microscope and XRF detector calls of control.py, with one session for a whole scan.
+
+        Inputs:
+            move: function(axis, position) returning once the axis is there, e.g. the
+                Controller.moveTo used by control.py
+            mercury: module of the XRF detector wrapper providing init, start_system, start_run,
+                get_spectrum and stop_run (the functions control.py calls); when it also
+                provides set_acquisition_values and get_run_data (Handel's
+                xiaSetAcquisitionValues / xiaGetRunData) a fixed realtime preset ends the run and
+                it is polled for 'run_active', otherwise it is stopped after realtime seconds
+            ini: detector configuration
+            realtime: XRF integration time in seconds
+            binning, exptime: TXM acquisition settings
+    '''
+
+    def __init__(self, move, mercury, ini='mercury_1.0.ini', realtime=30., binning=2, exptime=0.5):
+        self._move = move
+        self.mercury = mercury
+        self.ini = ini
+        self.realtime = realtime
+        self.binning = binning
+        self.exptime = exptime
+        self.microscope = None
+        self._run_started = None
+        self._preset = False
+
+    def open(self):
+        import xradia_helper
+        self.microscope = xradia_helper.Microscope(motorwait=True, verbose=False, timer=False)
+        self.microscope.OpenXrayShutter()
+        self.mercury.init(self.ini)
+        self.mercury.start_system()
+        # without a preset the run never ends by itself, the .ini does not set one
+        self._preset = hasattr(self.mercury, 'set_acquisition_values') and hasattr(self.mercury, 'get_run_data')
+        if self._preset:
+            self.mercury.set_acquisition_values(0, 'preset_type', 1.) # XIA_PRESET_FIXED_REAL
+            self.mercury.set_acquisition_values(0, 'preset_value', float(self.realtime))
+
+    def close(self):
+        if self.microscope is not None:
+            self.microscope.Shutdown()
+            self.microscope = None
+
+    def move(self, axis, position):
+        self._move(axis, position)
+
+    def start_xrf(self):
+        self.mercury.start_run(0)
+        self._run_started = time.time()
+
+    def xrf_running(self):
+        if self._preset:
+            return bool(self.mercury.get_run_data(0, 'run_active'))
+        return time.time() - self._run_started < self.realtime
+
+    def stop_xrf(self):
+        self.mercury.stop_run(0)
+
+    def read_xrf(self):
+        data = self.mercury.get_spectrum(0)
+        self.mercury.stop_run(0)
+        return np.asarray(data)
+
+    def capture_txm(self, path):
+        if not self.microscope.StartGISingleAcquisition(path + '.xrm', self.binning, self.exptime):
+            raise RuntimeError('could not collect image ' + path)
+
+
+class SimulatedBackend:
+    '''
+        Offline stand-in with the timing of the real devices, scaled by time_scale.
+
+        Every call sleeps for its modelled duration: session setup, moves at a constant speed
+        plus settling, XRF integration (realtime) and TXM exposure plus readout. Spectra are
+        Poisson counts and TXM images are saved as .npy.
+    '''
+
+    def __init__(self, realtime=30., exptime=0.5, readout=1.5, setup=10., speed=50., settle=0.5,
+                 n_channels=2048, image_shape=(512, 512), time_scale=1., seed=0):
+        self.realtime = realtime
+        self.exptime = exptime
+        self.readout = readout
+        self.setup = setup
+        self.speed = speed
+        self.settle = settle
+        self.n_channels = n_channels
+        self.image_shape = image_shape
+        self.time_scale = time_scale
+        self.rng = np.random.default_rng(seed)
+        self.positions = {}
+        self._run_started = None
+        self._lock = threading.Lock()
+
+    def _sleep(self, seconds):
+        time.sleep(seconds * self.time_scale)
+
+    def open(self):
+        self._sleep(self.setup)
+
+    def close(self):
+        self._sleep(self.setup / 10)
+
+    def move(self, axis, position):
+        with self._lock:
+            distance = abs(position - self.positions.get(axis, 0.))
+            self.positions[axis] = position
+        self._sleep(distance / self.speed + self.settle)
+
+    def start_xrf(self):
+        self._run_started = time.time()
+
+    def xrf_running(self):
+        return time.time() - self._run_started < self.realtime * self.time_scale
+
+    def stop_xrf(self):
+        pass
+
+    def read_xrf(self):
+        return self.rng.poisson(100., self.n_channels)
+
+    def capture_txm(self, path):
+        self._sleep(self.exptime + self.readout)
+        np.save(path + '.npy', self.rng.random(self.image_shape, dtype=np.float32))
+
+
+class AcquisitionScheduler:
+    '''
+        Scan of pattern positions with the device sessions opened once.
+
+        Per position all axes move in parallel, then the XRF run starts and the TXM image is
+        exposed while the spectrum integrates; the run status is polled every poll_interval
+        seconds, and a run still active timeout seconds after its realtime is stopped and raises
+        TimeoutError. Spectra are written by a background thread while the next position is moved to.
+        sequential=True reproduces control.py's moveMotorAndCapture (sessions per position,
+        one axis after the other, a fixed wait, TXM after XRF) for comparison.
+
+        Inputs:
+            backend: XradiaBackend or SimulatedBackend
+            outdir: directory of the <name>.mat spectra and <name> TXM images
+            poll_interval: seconds between two run status checks
+            timeout: seconds past the realtime before a run counts as hung
+    '''
+
+    def __init__(self, backend, outdir='.', poll_interval=0.05, sequential=False, timeout=10.):
+        self.backend = backend
+        self.outdir = outdir
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.sequential = sequential
+        self.timings = []
+        os.makedirs(outdir, exist_ok=True)
+
+    def __enter__(self):
+        if not self.sequential:
+            self.backend.open()
+        return self
+
+    def __exit__(self, *exc):
+        if not self.sequential:
+            self.backend.close()
+
+    def _move(self, axes, positions, pool):
+        if self.sequential:
+            for axis, position in zip(axes, positions):
+                self.backend.move(axis, position)
+        else:
+            list(pool.map(self.backend.move, axes, positions))
+
+    def _save_xrf(self, path, data):
+        scipy.io.savemat(path + '.mat', dict(data=data))
+
+    def scan(self, axes, positions, names):
+        '''
+            axes: axis names (see control.XradiaAxisNameList), positions: one sequence of
+            positions per pattern, names: file name per pattern
+        '''
+        with ThreadPoolExecutor(max(len(axes), 1)) as pool, ThreadPoolExecutor(1) as writer:
+            pending = []
+            for position, name in zip(positions, names):
+                path = os.path.join(self.outdir, name)
+                start = time.time()
+                self._move(axes, position, pool)
+                moved = time.time()
+                if self.sequential:
+                    self.backend.open()
+                    self.backend.start_xrf()
+                    time.sleep(self.backend.realtime * getattr(self.backend, 'time_scale', 1.))
+                    data = self.backend.read_xrf()
+                    self._save_xrf(path, data)
+                    self.backend.capture_txm(path)
+                    self.backend.close()
+                else:
+                    time_scale = getattr(self.backend, 'time_scale', 1.)
+                    deadline = time.time() + (self.backend.realtime + self.timeout) * time_scale
+                    self.backend.start_xrf()
+                    self.backend.capture_txm(path)
+                    while self.backend.xrf_running():
+                        if time.time() > deadline:
+                            self.backend.stop_xrf()
+                            raise TimeoutError("XRF run of %s still active %.0f s after its realtime"
+                                               % (name, self.timeout))
+                        time.sleep(self.poll_interval)
+                    pending.append(writer.submit(self._save_xrf, path, self.backend.read_xrf()))
+                self.timings.append({"name": name, "move": moved - start, "acquire": time.time() - moved})
+            for future in pending:
+                future.result()
+        return self.timings
+
+
+def patterns_per_hour(timings, time_scale=1.):
+    return 3600. / (np.sum([t["move"] + t["acquire"] for t in timings]) / len(timings) / time_scale)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput of the acquisition scheduler on the simulated devices')
+    parser.add_argument('--patterns', type=int, default=20)
+    parser.add_argument('--realtime', type=float, default=30., help='XRF integration time [s]')
+    parser.add_argument('--exptime', type=float, default=0.5, help='TXM exposure [s]')
+    parser.add_argument('--time-scale', type=float, default=0.01, help='simulated seconds per real second')
+    parser.add_argument('--outdir', default='acquisition_sim')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    axes = ['phx', 'phy', 'cdx', 'cdy']
+    positions = rng.integers(-200, 200, (args.patterns, len(axes))).tolist()
+    names = ['pattern_%04d' % i for i in range(args.patterns)]
+    print("%12s %14s %12s %14s" % ("mode", "patterns/hour", "move [s]", "acquire [s]"))
+    for sequential in (True, False):
+        backend = SimulatedBackend(realtime=args.realtime, exptime=args.exptime, time_scale=args.time_scale,
+                                   image_shape=(64, 64))
+        with AcquisitionScheduler(backend, args.outdir, poll_interval=0.01 * args.time_scale,
+                                  sequential=sequential) as scheduler:
+            timings = scheduler.scan(axes, positions, names)
+        print("%12s %14.1f %12.2f %14.2f" % (
+            "sequential" if sequential else "pipelined", patterns_per_hour(timings, args.time_scale),
+            np.mean([t["move"] for t in timings]) / args.time_scale,
+            np.mean([t["acquire"] for t in timings]) / args.time_scale))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+# Micro-benchmarks of the reconstruction building blocks
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from skimage import data as skdata
+from torchvision.transforms import Resize, Compose, ToTensor
+
+from utils import get_mgrid, cal_gradient, CompressiveImaging, gradient_loss, psnr
+from model import PosEncoding, Siren, INR
+from dataset import load_mat
+from reconstructor import ReconConfig, Reconstructor
+from solvers import SOLVERS, build_solver
+from simulation import quality
+from telemetry import Telemetry
+
+
+def timeit(fn, repeat=10, warmup=2):
+    '''Median wall time of fn() in milliseconds'''
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1e3
+
+
+def legacy_pos_encoding(enc, coords):
+    '''PosEncoding.forward before vectorization, kept as the reference'''
+    coords = coords.view(coords.shape[0], -1, enc.in_features)
+
+    coords_pos_enc = coords
+    for i in range(enc.num_frequencies):
+        for j in range(enc.in_features):
+            c = coords[..., j]
+
+            sin = torch.unsqueeze(torch.sin((2 ** i) * np.pi * c), -1)
+            cos = torch.unsqueeze(torch.cos((2 ** i) * np.pi * c), -1)
+
+            coords_pos_enc = torch.cat((coords_pos_enc, sin, cos), axis=-1)
+
+    return coords_pos_enc.reshape(coords.shape[0], -1, enc.out_dim)
+
+
+def bench_posenc(args):
+    print("%8s %6s %12s %12s %12s %9s" % ("size", "freqs", "loop [ms]", "vector [ms]", "cached [ms]", "max err"))
+    for size in args.sizes:
+        enc = PosEncoding(in_features=2, sidelength=size)
+        coords = get_mgrid(size, 2).unsqueeze(0)
+        reference = legacy_pos_encoding(enc, coords)
+        err = (reference - enc.encode(coords)).abs().max().item()
+
+        t_loop = timeit(lambda: legacy_pos_encoding(enc, coords), args.repeat)
+        t_vec = timeit(lambda: enc.encode(coords), args.repeat)
+        t_cached = timeit(lambda: enc(coords), args.repeat)
+        print("%8s %6d %12.3f %12.3f %12.4f %9.1e" % ("%d^2" % size, enc.num_frequencies, t_loop, t_vec, t_cached, err))
+
+
+def bench_siren(args):
+    coords = get_mgrid(args.image_size, 2).unsqueeze(0)
+    modes = ['eager', 'fused', 'compile']
+    print("%d coordinates, forward + backward" % coords.shape[1])
+    print("%7s %6s " % ("width", "depth") + " ".join("%13s" % (m + " [ms]") for m in modes) + " %9s" % "max err")
+    for width in args.widths:
+        for depth in args.depths:
+            torch.manual_seed(0)
+            siren = Siren(in_features=2, out_features=1, hidden_features=width,
+                          hidden_layers=depth, outermost_linear=True)
+            times, outputs = [], []
+            for mode in modes:
+                for layer in siren.net:
+                    if hasattr(layer, 'mode'):
+                        layer.mode = mode
+
+                def step():
+                    siren.zero_grad()
+                    output, _ = siren(coords)
+                    output.square().mean().backward()
+                    return output
+
+                outputs.append(step().detach())
+                times.append(timeit(step, args.repeat))
+            err = max((o - outputs[0]).abs().max().item() for o in outputs[1:])
+            print("%7d %6d " % (width, depth) + " ".join("%13.2f" % t for t in times) + " %9.1e" % err)
+
+
+def saved_tensor_bytes(fn):
+    '''Run fn() and return the bytes of all tensors autograd saved for backward'''
+    total = [0]
+
+    def pack(tensor):
+        total[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return total[0]
+
+
+def bench_input_grad(args):
+    coords = get_mgrid(args.image_size, 2).unsqueeze(0)
+    print("%d coordinates, width %d, %d hidden layers, forward + backward" % (coords.shape[1], args.width, args.depth))
+    print("%16s %12s %18s" % ("need_input_grad", "time [ms]", "saved [MiB]"))
+    torch.manual_seed(0)
+    siren = Siren(in_features=2, out_features=1, hidden_features=args.width,
+                  hidden_layers=args.depth, outermost_linear=True, mode=args.mode)
+    for need_input_grad in (True, False):
+        siren.need_input_grad = need_input_grad
+
+        def step():
+            siren.zero_grad()
+            output, _ = siren(coords)
+            output.square().mean().backward()
+
+        saved = saved_tensor_bytes(step)
+        print("%16s %12.2f %18.2f" % (need_input_grad, timeit(step, args.repeat), saved / 2 ** 20))
+
+
+def simulated_problem(image_size, sampling_ratio, filename=None, seed=0):
+    '''
+        Simulated measurement through CompressiveImaging, as in utils.load_data.
+
+        Uses <filename>_size_<N>_sampling_<R>.mat when given, otherwise uniform random patterns
+        and the scikit-image camera phantom.
+
+        Outputs:
+            A: (n_patterns, n_pixels) tensor, img: (H, W) ground truth, compressed: (n_patterns,)
+    '''
+    if filename is not None:
+        mat = load_mat(filename + '_size_' + str(image_size) + "_sampling_" + str(sampling_ratio) + '.mat')
+        A = torch.tensor(mat['h'], dtype=torch.float32).T
+        img = Image.fromarray(np.array(mat['z']))
+    else:
+        rng = np.random.default_rng(seed)
+        n_patterns = int(round(sampling_ratio * image_size ** 2))
+        A = torch.from_numpy(rng.random((n_patterns, image_size ** 2), dtype=np.float32))
+        img = Image.fromarray(skdata.camera())
+    img = Compose([Resize(image_size), ToTensor()])(img)
+    Gx, Gy = cal_gradient(img[0, :, :])
+    data = CompressiveImaging(image_size, A, 0, Gx, Gy, img)
+    return A, img[0], data.compressed[:, 0]
+
+
+def bench_precision(args):
+    A, img, compressed = simulated_problem(args.image_size, args.sampling_ratio, args.filename)
+    policies = [('fp32', 'fp32'), ('bf16', 'fp32'), ('fp32', 'bf16'), ('fp32', 'fp16'), ('bf16', 'bf16')]
+    if torch.cuda.is_available():
+        policies.append(('fp16', 'fp16'))
+    print("%d patterns, %d^2 pixels, %d steps" % (A.shape[0], args.image_size, args.steps))
+    print("%8s %8s %10s %10s %8s %10s" % ("compute", "A", "PSNR [dB]", "RSNR [dB]", "SSIM", "time [s]"))
+    for compute, storage in policies:
+        cfg = ReconConfig(image_size=args.image_size, hidden_features=args.width, hidden_layers=args.depth,
+                          lr=args.lr, alpha=1, total_steps=args.steps, exit_window=args.steps // 10,
+                          early_stopping=False, precision=compute, pattern_dtype=storage,
+                          device=args.device, seed=0)
+        reconstructor = Reconstructor(cfg, A.T.numpy())
+        reconstructor.set_prior(img, prepared=True)
+        result = reconstructor.fit(compressed.numpy())
+        print("%8s %8s %10.2f %10.2f %8.4f %10.1f" % ((compute, storage) + quality(img, result['xhat'][0])
+                                                       + (result['time'],)))
+
+
+def bench_solvers(args):
+    A, img, compressed = simulated_problem(args.image_size, args.sampling_ratio, args.filename)
+    cfg = ReconConfig(image_size=args.image_size, hidden_features=args.width, hidden_layers=args.depth,
+                      lr=args.lr, tv_weight=args.tv_weight, alpha=1, total_steps=args.steps,
+                      exit_window=args.steps // 10, early_stopping=False, device=args.device, seed=0)
+    reconstructor = Reconstructor(cfg, A.T.numpy())
+    reconstructor.set_prior(img, prepared=True)
+    print("%d patterns, %d^2 pixels" % (A.shape[0], args.image_size))
+    print("%10s %10s %10s %8s %12s %10s" % ("solver", "PSNR [dB]", "RSNR [dB]", "SSIM", "y_loss", "time [s]"))
+    for name in SOLVERS:
+        options = {"lam": args.lam} if name == 'tikhonov' else (
+            {"lam": args.lam, "iterations": args.iterations} if name in ('cg', 'lsqr')
+            else {"tv_weight": args.tv_weight, "iterations": args.iterations})
+        result = build_solver(name, reconstructor.op, args.image_size, **options).solve(compressed, reconstructor.TXM)
+        print("%10s %10.2f %10.2f %8.4f %12.4g %10.2f" % ((name,) + quality(img, result['xhat'][0])
+                                                          + (result['y_loss'], result['time'])))
+    result = reconstructor.fit(compressed.numpy())
+    print("%10s %10.2f %10.2f %8.4f %12.4g %10.2f" % (('inr',) + quality(img, result['xhat'][0])
+                                                      + (result['y_loss'], result['time'])))
+
+
+class QualitySink:
+    '''Telemetry sink keeping the PSNR of every recon_TXM snapshot (first element) against img'''
+
+    def __init__(self, img):
+        self.img = np.asarray(img, dtype=np.float32)
+        self.curve = []
+
+    def write_metrics(self, step, metrics):
+        pass
+
+    def write_image(self, step, name, image):
+        if name == 'recon_TXM':
+            n = self.img.shape[0]
+            self.curve.append((step, float(psnr(self.img, image[:, :n].T))))
+
+    def close(self):
+        pass
+
+
+def suite_timings(args):
+    '''Median milliseconds of every building block, keyed "<block>/<setting>"'''
+    timings = {}
+    for size in args.sizes:
+        timings["get_mgrid/%d" % size] = timeit(lambda: get_mgrid(size, 2), args.repeat)
+        enc = PosEncoding(in_features=2, sidelength=size)
+        coords = get_mgrid(size, 2).unsqueeze(0)
+        timings["posenc/%d" % size] = timeit(lambda: enc.encode(coords), args.repeat)
+        frames = torch.rand(args.restarts, 3, size, size, requires_grad=True)
+        target = torch.rand(size, size)
+        timings["gradient_loss/%d" % size] = timeit(lambda: gradient_loss(frames, target).backward(), args.repeat)
+
+    coords = get_mgrid(args.image_size, 2).unsqueeze(0)
+    for width in args.widths:
+        torch.manual_seed(0)
+        siren = Siren(in_features=2, out_features=3, hidden_features=width, hidden_layers=args.depth,
+                      outermost_linear=True)
+        inr = INR(in_features=2, hidden_features=width, hidden_layers=args.depth, out_features=3,
+                  sidelength=args.image_size).train(False)
+        for name, net in (("siren", siren), ("inr", inr)):
+            net.need_input_grad = False
+            with torch.no_grad():
+                timings["%s_forward/%d" % (name, width)] = timeit(lambda: net(coords), args.repeat)
+
+            def step():
+                net.zero_grad()
+                output, _ = net(coords)
+                output.square().mean().backward()
+
+            timings["%s_backward/%d" % (name, width)] = timeit(step, args.repeat)
+
+    generator = torch.Generator().manual_seed(0)
+    n_pixels = args.image_size ** 2
+    x = torch.rand(n_pixels, 3, generator=generator)
+    for ratio in args.samplings:
+        A = torch.rand(int(round(ratio * n_pixels)), n_pixels, generator=generator)
+        timings["projection/%g" % ratio] = timeit(lambda: A @ x, args.repeat)
+    return timings
+
+
+def suite_quality(args):
+    '''Steps and time until the simulated reconstruction reaches target_psnr, and its final quality'''
+    A, img, compressed = simulated_problem(args.image_size, args.sampling_ratio, seed=0)
+    cfg = ReconConfig(image_size=args.image_size, hidden_features=args.width, hidden_layers=args.depth,
+                      lr=args.lr, alpha=1, total_steps=args.steps, exit_window=args.steps // 10,
+                      steps_til_summary=args.summary_every, early_stopping=False, device='cpu', seed=0)
+    reconstructor = Reconstructor(cfg, A.T.numpy())
+    reconstructor.set_prior(img, prepared=True)
+    sink = QualitySink(img)
+    # room for every record (a metrics record and a snapshot per summary), so none is dropped
+    telemetry = Telemetry([sink], max_queue=2 * (args.steps // args.summary_every + 1) + 1, profile_every=0)
+    result = reconstructor.fit(compressed.numpy(), telemetry=telemetry)
+    telemetry.close()
+    if telemetry.dropped:
+        raise RuntimeError("telemetry dropped %d records, the PSNR curve is incomplete" % telemetry.dropped)
+
+    reached = [step for step, value in sink.curve if value >= args.target_psnr]
+    p, r, s = quality(img, result['xhat'][0])
+    return {"psnr": float(p), "rsnr": float(r), "ssim": s, "time": result['time'],
+            "ms_per_step": result['time'] / result['steps'] * 1e3, "target_psnr": args.target_psnr,
+            "steps_to_target": reached[0] if reached else None, "psnr_curve": sink.curve}
+
+
+def bench_suite(args):
+    torch.set_num_threads(args.threads or 1)
+    torch.manual_seed(0)
+    start = time.time()
+    report = {"meta": {"date": time.strftime('%Y-%m-%d %H:%M:%S'), "python": platform.python_version(),
+                       "torch": torch.__version__, "numpy": np.__version__, "machine": platform.machine(),
+                       "processor": platform.processor(), "threads": torch.get_num_threads(),
+                       "repeat": args.repeat},
+              "timings": suite_timings(args),
+              "quality": suite_quality(args)}
+    report["meta"]["duration"] = time.time() - start
+    for name, ms in report["timings"].items():
+        print("%28s %12.3f ms" % (name, ms))
+    q = report["quality"]
+    print("PSNR %.2f dB, RSNR %.2f dB, SSIM %.4f, %.2f ms/step, %s steps to %.1f dB"
+          % (q["psnr"], q["rsnr"], q["ssim"], q["ms_per_step"], q["steps_to_target"], q["target_psnr"]))
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("saved %s" % args.out)
+
+
+def bench_compare(args):
+    '''
+        Regressions of args.new against args.base: timings more than time_tol (relative) and
+        min_ms (absolute, below that is timer noise) slower, PSNR/RSNR more than db_tol lower,
+        SSIM more than ssim_tol lower, or more steps to the target PSNR (or not reaching it any
+        more). Exits with 1 when there are any.
+    '''
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    regressions = 0
+    print("%28s %12s %12s %9s" % ("", "base", "new", "change"))
+    for name in base["timings"]:
+        if name not in new["timings"]:
+            continue
+        b, n = base["timings"][name], new["timings"][name]
+        slower = n > b * (1 + args.time_tol) and n - b > args.min_ms
+        regressions += slower
+        print("%28s %12.3f %12.3f %+8.1f%% %s" % (name, b, n, (n / b - 1) * 100, "REGRESSION" if slower else ""))
+
+    bq, nq = base["quality"], new["quality"]
+    for name, tol in (("psnr", args.db_tol), ("rsnr", args.db_tol), ("ssim", args.ssim_tol)):
+        worse = nq[name] < bq[name] - tol
+        regressions += worse
+        print("%28s %12.4f %12.4f %+9.4f %s" % (name, bq[name], nq[name], nq[name] - bq[name],
+                                                "REGRESSION" if worse else ""))
+    b, n = bq["steps_to_target"], nq["steps_to_target"]
+    worse = bq["target_psnr"] == nq["target_psnr"] and b is not None and (n is None or n > b)
+    regressions += worse
+    print("%28s %12s %12s %9s %s" % ("steps_to_target", b, n, "", "REGRESSION" if worse else ""))
+    if bq["target_psnr"] != nq["target_psnr"]:
+        print("warning: the runs use different target PSNRs, steps_to_target is not compared")
+    if base["meta"].get("machine") != new["meta"].get("machine") or base["meta"].get("threads") != new["meta"].get("threads"):
+        print("warning: the runs differ in machine or threads, timings are not comparable")
+    print("%d regression(s)" % regressions)
+    if regressions:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the reconstruction building blocks')
+    parser.add_argument('--threads', type=int, default=None, help='torch threads')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('posenc', help='loop vs vectorized vs cached PosEncoding')
+    p.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512])
+    p.add_argument('--repeat', type=int, default=10)
+    p.set_defaults(func=bench_posenc)
+
+    p = sub.add_parser('siren', help='eager vs fused vs compiled Siren forward/backward')
+    p.add_argument('--image-size', type=int, default=64)
+    p.add_argument('--widths', type=int, nargs='+', default=[128, 256, 512, 1024])
+    p.add_argument('--depths', type=int, nargs='+', default=[3, 5])
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_siren)
+
+    p = sub.add_parser('input-grad', help='Siren with and without input gradients')
+    p.add_argument('--image-size', type=int, default=128)
+    p.add_argument('--width', type=int, default=1024)
+    p.add_argument('--depth', type=int, default=5)
+    p.add_argument('--mode', default='eager', choices=['eager', 'fused', 'compile'])
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_input_grad)
+
+    p = sub.add_parser('precision', help='accuracy and time of the precision policies on simulated data')
+    p.add_argument('--filename', default=None, help='<filename>_size_<N>_sampling_<R>.mat, default synthetic')
+    p.add_argument('--image-size', type=int, default=64)
+    p.add_argument('--sampling-ratio', type=float, default=0.3)
+    p.add_argument('--width', type=int, default=256)
+    p.add_argument('--depth', type=int, default=3)
+    p.add_argument('--lr', type=float, default=1e-4)
+    p.add_argument('--steps', type=int, default=1000)
+    p.add_argument('--device', default=None)
+    p.set_defaults(func=bench_precision)
+
+    p = sub.add_parser('solvers', help='classical solvers against the INR on simulated data')
+    p.add_argument('--filename', default=None, help='<filename>_size_<N>_sampling_<R>.mat, default synthetic')
+    p.add_argument('--image-size', type=int, default=64)
+    p.add_argument('--sampling-ratio', type=float, default=0.3)
+    p.add_argument('--lam', type=float, default=0., help='Tikhonov weight of tikhonov, cg and lsqr')
+    p.add_argument('--tv-weight', type=float, default=1e-5)
+    p.add_argument('--iterations', type=int, default=200)
+    p.add_argument('--width', type=int, default=256)
+    p.add_argument('--depth', type=int, default=3)
+    p.add_argument('--lr', type=float, default=1e-4)
+    p.add_argument('--steps', type=int, default=1000)
+    p.add_argument('--device', default=None)
+    p.set_defaults(func=bench_solvers)
+
+    p = sub.add_parser('suite', help='deterministic timing and quality baseline, saved as JSON')
+    p.add_argument('--out', default='benchmark.json')
+    p.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 256], help='grids of get_mgrid, PosEncoding, gradient_loss')
+    p.add_argument('--image-size', type=int, default=64)
+    p.add_argument('--widths', type=int, nargs='+', default=[64, 256, 512])
+    p.add_argument('--depth', type=int, default=3)
+    p.add_argument('--restarts', type=int, default=2)
+    p.add_argument('--samplings', type=float, nargs='+', default=[0.1, 0.3, 1.0], help='pattern counts of A @ x')
+    p.add_argument('--sampling-ratio', type=float, default=0.3)
+    p.add_argument('--width', type=int, default=128)
+    p.add_argument('--lr', type=float, default=1e-4)
+    p.add_argument('--steps', type=int, default=1000)
+    p.add_argument('--summary-every', type=int, default=50)
+    p.add_argument('--target-psnr', type=float, default=20.)
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_suite)
+
+    p = sub.add_parser('compare', help='flag regressions between two suite results')
+    p.add_argument('base')
+    p.add_argument('new')
+    p.add_argument('--time-tol', type=float, default=0.1, help='tolerated relative slowdown')
+    p.add_argument('--db-tol', type=float, default=0.1, help='tolerated PSNR/RSNR loss in dB')
+    p.add_argument('--min-ms', type=float, default=0.05, help='tolerated absolute slowdown in ms')
+    p.add_argument('--ssim-tol', type=float, default=0.005)
+    p.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
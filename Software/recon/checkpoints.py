@@ -0,0 +1,115 @@
+# Warm-start store of trained networks, with LRU eviction on disk
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+
+def pattern_hash(patterns, chunk=1024):
+    '''Content hash of a pattern stack (n_pixels, n_patterns), read in blocks of patterns'''
+    h = hashlib.sha1(str(patterns.shape).encode())
+    for j in range(0, patterns.shape[1], chunk):
+        h.update(np.ascontiguousarray(patterns[:, j:j + chunk], dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+
+def architecture(cfg):
+    '''Fields of a ReconConfig that must match for a state dict to load'''
+    return {"hidden_features": cfg.hidden_features, "hidden_layers": cfg.hidden_layers,
+            "num_restarts": cfg.num_restarts, "first_omega_0": cfg.first_omega_0,
+            "hidden_omega_0": cfg.hidden_omega_0}
+
+
+class CheckpointStore:
+    '''
+        Trained SirenEnsemble and Adam states keyed by (pattern set, image size, elements).
+
+        Each key holds the latest model trained for it, saved as <directory>/<id>.pt, with the
+        keys, sizes and last use times in <directory>/index.json. Saving evicts the least recently
+        used checkpoints beyond max_bytes.
+
+        nearest() also accepts checkpoints of another pattern set or image size: the network is
+        continuous in the coordinates, so any model of the same elements and architecture is a
+        better start than a random one. Candidates rank by same pattern set, then same image size,
+        then most recent use.
+
+        Inputs:
+            directory: checkpoint directory, created if needed
+            max_bytes: disk budget, None keeps everything
+    '''
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, 'index.json')
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _save_index(self, index):
+        tmp = self.index_path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, self.index_path)
+
+    @staticmethod
+    def key(patterns_hash, image_size, elements, cfg):
+        meta = {"patterns": patterns_hash, "image_size": image_size, "elements": list(elements),
+                "architecture": architecture(cfg)}
+        return hashlib.sha1(json.dumps(meta, sort_keys=True).encode()).hexdigest()[:16], meta
+
+    def _path(self, entry_id):
+        return os.path.join(self.directory, entry_id + '.pt')
+
+    def save(self, patterns_hash, image_size, elements, cfg, model, optimizer=None, **info):
+        '''Store model (and optimizer) state for the key, extra info (e.g. steps, y_loss) goes to the index'''
+        entry_id, meta = self.key(patterns_hash, image_size, elements, cfg)
+        tmp = self._path(entry_id) + '.%d.tmp' % os.getpid()
+        torch.save({"model": model.state_dict(),
+                    "optimizer": None if optimizer is None else optimizer.state_dict(),
+                    "meta": meta}, tmp)
+        os.replace(tmp, self._path(entry_id))
+
+        index = self._load_index()
+        index[entry_id] = dict(meta, bytes=os.path.getsize(self._path(entry_id)), last_used=time.time(), **info)
+        self._evict(index, keep=entry_id)
+        self._save_index(index)
+        return entry_id
+
+    def _evict(self, index, keep=None):
+        if self.max_bytes is None:
+            return
+        total = sum(entry["bytes"] for entry in index.values())
+        for entry_id in sorted(index, key=lambda e: index[e]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if entry_id == keep:
+                continue
+            total -= index.pop(entry_id)["bytes"]
+            if os.path.exists(self._path(entry_id)):
+                os.remove(self._path(entry_id))
+
+    def nearest(self, patterns_hash, image_size, elements, cfg):
+        '''Id of the best compatible checkpoint, or None'''
+        arch = architecture(cfg)
+        candidates = [(entry["patterns"] == patterns_hash, entry["image_size"] == image_size, entry["last_used"], entry_id)
+                      for entry_id, entry in self._load_index().items()
+                      if entry["elements"] == list(elements) and entry["architecture"] == arch
+                      and os.path.exists(self._path(entry_id))]
+        return max(candidates)[-1] if candidates else None
+
+    def load(self, entry_id, model, device='cpu'):
+        '''Load the model weights in place, returns (optimizer state or None, index entry)'''
+        state = torch.load(self._path(entry_id), map_location=device)
+        model.load_state_dict(state["model"])
+        index = self._load_index()
+        index[entry_id]["last_used"] = time.time()
+        self._save_index(index)
+        return state["optimizer"], index[entry_id]
@@ -0,0 +1,146 @@
+# Convergence detection for the reconstruction loop
+import numpy as np
+import torch
+
+
+def residual_target(compressed, noise_level, alpha=1, tau=1.0):
+    '''
+        Mean squared data residual expected from measurement noise alone (discrepancy principle).
+
+        Inputs:
+            compressed: (n_patterns, n_elements) scaled XRF measurements
+            noise_level: 'poisson' for counting noise, or the std of one raw XRF value
+            alpha: scaling applied to the raw XRF values
+            tau: safety factor, training stops once residual <= tau * noise floor
+
+        Outputs:
+            target: (n_elements,) tensor of per-element mean squared residuals
+    '''
+    if noise_level == 'poisson':
+        # var(alpha * counts) = alpha^2 * counts = alpha * compressed
+        floor = alpha * compressed.abs().mean(0)
+    else:
+        floor = torch.full((compressed.shape[1],), (alpha * float(noise_level)) ** 2,
+                           device=compressed.device)
+    return tau * floor
+
+
+class ConvergenceMonitor:
+    '''
+        Stops training on a loss plateau or once the data residual reaches the noise floor.
+
+        Losses are accumulated on the device and only read back once per window, so the monitor
+        adds one host sync every `window` steps. A window whose mean loss changed by less than
+        `rtol` relative to the previous window counts towards `patience`; `patience` such windows
+        in a row mean the loss has plateaued.
+
+        With point_estimates the per-step losses are noisy (mini-batched data terms) and only the
+        loss and residual passed on the last step of a window (see `due`), computed exactly by the
+        caller, are used.
+    '''
+
+    def __init__(self, window=500, rtol=1e-3, patience=3, min_steps=0, residual_target=None, point_estimates=False):
+        self.window = window
+        self.rtol = rtol
+        self.patience = patience
+        self.min_steps = min_steps
+        self.residual_target = residual_target
+        self.point_estimates = point_estimates
+
+        self.window_sum = None
+        self.count = 0
+        self.previous = None
+        self.num_flat = 0
+        self.history = []
+
+    @property
+    def due(self):
+        '''True when the next update() closes a window and reads the loss and residual'''
+        return self.count + 1 >= self.window
+
+    def update(self, step, loss, residual=None):
+        '''
+            Inputs:
+                step: current step
+                loss: scalar loss tensor of this step
+                residual: optional (n_members, n_elements) mean squared data residuals
+
+            Outputs:
+                None while training should go on, else the reason to stop ('plateau' or 'residual')
+        '''
+        loss = loss.detach()
+        self.window_sum = loss if self.window_sum is None else self.window_sum + loss
+        self.count += 1
+        if self.count < self.window:
+            return None
+
+        mean = loss.item() if self.point_estimates else self.window_sum.item() / self.count
+        self.window_sum, self.count = None, 0
+        self.history.append((step, mean))
+
+        if self.previous is not None:
+            change = abs(self.previous - mean) / max(abs(self.previous), np.finfo(np.float32).tiny)
+            self.num_flat = self.num_flat + 1 if change < self.rtol else 0
+        self.previous = mean
+
+        if step + 1 < self.min_steps:
+            return None
+        if residual is not None and self.residual_target is not None:
+            # any member whose every element is within the noise floor is good enough
+            if bool((residual.detach() <= self.residual_target).all(-1).any()):
+                return 'residual'
+        if self.num_flat >= self.patience:
+            return 'plateau'
+        return None
+
+
+class BestIterateTracker:
+    '''
+        Lowest-loss iterate of every member, kept on the device.
+
+        The running minimum loss and a preallocated output buffer are updated with torch.where,
+        so tracking never synchronizes with the host; result() is the only transfer. With
+        ema_decay, a Polyak (exponential moving) average of the outputs is kept alongside as a
+        lower-noise alternative to the single best iterate. It starts from zero and is divided by
+        1 - ema_decay^n (bias correction, as Adam), so the first tracked iterate only weighs as
+        much as the decay gives it, however short the window.
+    '''
+
+    def __init__(self, ema_decay=None):
+        self.ema_decay = ema_decay
+        self.best_loss = None
+        self.best = None
+        self.best_step = None
+        self.ema = None
+        self.ema_count = 0
+
+    @torch.no_grad()
+    def update(self, step, loss, output):
+        '''
+            Inputs:
+                step: current step
+                loss: (n_members,) loss tensor
+                output: (n_members, ...) iterate of every member
+        '''
+        loss, output = loss.detach(), output.detach()
+        if self.best is None:
+            self.best_loss = loss.clone()
+            self.best = output.clone()
+            self.best_step = torch.full_like(loss, step, dtype=torch.long)
+            if self.ema_decay is not None:
+                self.ema = torch.zeros_like(output)
+        else:
+            better = loss < self.best_loss
+            self.best_loss.copy_(torch.where(better, loss, self.best_loss))
+            self.best_step.masked_fill_(better, step)
+            self.best.copy_(torch.where(better.view(-1, *[1] * (output.dim() - 1)), output, self.best))
+        if self.ema is not None:
+            self.ema.lerp_(output, 1 - self.ema_decay)
+            self.ema_count += 1
+
+    def result(self):
+        '''Outputs: dict of numpy arrays best_loss, best, best_step and ema (None without ema_decay)'''
+        return {"best_loss": self.best_loss.cpu().numpy(),
+                "best": self.best.cpu().numpy(),
+                "best_step": self.best_step.cpu().numpy(),
+                "ema": None if self.ema is None else (self.ema / (1 - self.ema_decay ** self.ema_count)).cpu().numpy()}
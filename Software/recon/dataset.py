@@ -0,0 +1,141 @@
+# Cached, memory-mapped loader for the .mat datasets
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+from scipy.io import loadmat
+
+try:
+    import h5py
+except ImportError: # only needed for v7.3 .mat files
+    h5py = None
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+
+def is_hdf5(path):
+    '''True for v7.3 .mat files, which are HDF5 with a 512 byte MATLAB header'''
+    with open(path, 'rb') as f:
+        for offset in (0, 512):
+            f.seek(offset)
+            if f.read(8) == HDF5_SIGNATURE:
+                return True
+    return False
+
+
+def file_hash(path, chunk_size=1 << 24):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class MatDataset:
+    '''
+        Read-only view of a .mat file backed by .npy sidecars.
+
+        The first access decodes the file once (every numeric variable of a v5 file, or only the
+        requested variable of a v7.3/HDF5 file, read lazily through h5py) and stores each array
+        as <cache_dir>/<content hash>/<name>.npy. Floating point arrays are stored as float32,
+        integer arrays (e.g. a uint8 TXM image) keep their dtype. Later accesses, also from other
+        processes, memory-map the sidecars. The content hash is remembered per (size, mtime) in
+        <cache_dir>/index/<hash of the path>.json, one small file per dataset replaced atomically,
+        so an unchanged file is not re-hashed and concurrent processes never share an index file.
+
+        Inputs:
+            path: .mat file, the extension may be omitted
+            cache_dir: sidecar directory, defaults to .mat_cache next to the file
+    '''
+
+    def __init__(self, path, cache_dir=None):
+        if not path.endswith('.mat') and not os.path.exists(path):
+            path = path + '.mat'
+        self.path = os.path.abspath(path)
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(os.path.dirname(self.path), '.mat_cache')
+        self.hdf5 = is_hdf5(self.path)
+        self.hash = self._content_hash()
+        self.directory = os.path.join(self.cache_dir, self.hash)
+        self.arrays = {}
+
+    def _content_hash(self):
+        index_dir = os.path.join(self.cache_dir, 'index')
+        os.makedirs(index_dir, exist_ok=True)
+        index_path = os.path.join(index_dir, hashlib.sha1(self.path.encode()).hexdigest() + '.json')
+        stat = os.stat(self.path)
+        entry = None
+        if os.path.exists(index_path):
+            try:
+                with open(index_path) as f:
+                    entry = json.load(f)
+            except ValueError:
+                entry = None # unreadable, hash again
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['hash']
+
+        digest = file_hash(self.path)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=index_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'path': self.path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest}, f)
+        os.replace(tmp, index_path)
+        return digest
+
+    def _sidecar(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    @staticmethod
+    def _store_dtype(array):
+        return np.float32 if np.issubdtype(array.dtype, np.floating) else array.dtype
+
+    def _save(self, key, array):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self._sidecar(key) + '.%d.tmp.npy' % os.getpid()
+        np.save(tmp, np.ascontiguousarray(array, dtype=self._store_dtype(array)))
+        os.replace(tmp, self._sidecar(key))
+
+    def _decode(self, key):
+        if self.hdf5:
+            if h5py is None:
+                raise ImportError("reading v7.3 .mat files requires h5py")
+            with h5py.File(self.path, 'r') as f:
+                if key not in f:
+                    raise KeyError(key)
+                # MATLAB writes column-major, transpose back to the loadmat layout
+                self._save(key, f[key][()].T)
+            return
+        mat = loadmat(self.path)
+        for name, value in mat.items():
+            if not name.startswith('__') and isinstance(value, np.ndarray) and value.dtype.kind in 'biuf':
+                self._save(name, value)
+        if key not in mat:
+            raise KeyError(key)
+
+    def __getitem__(self, key):
+        if key not in self.arrays:
+            if not os.path.exists(self._sidecar(key)):
+                self._decode(key)
+            self.arrays[key] = np.load(self._sidecar(key), mmap_mode='r')
+        return self.arrays[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+
+_datasets = {}
+
+
+def load_mat(path, cache_dir=None):
+    '''MatDataset for path, shared within the process as long as the file is unchanged'''
+    if not path.endswith('.mat') and not os.path.exists(path):
+        path = path + '.mat'
+    stat = os.stat(path)
+    key = (os.path.abspath(path), cache_dir, stat.st_size, stat.st_mtime_ns)
+    if key not in _datasets:
+        _datasets[key] = MatDataset(path, cache_dir)
+    return _datasets[key]
@@ -0,0 +1,131 @@
+# Fourier ring/shell correlation, port of FourierShellCorrelate.m and getFSC.m
+import functools
+
+import numpy as np
+
+
+def kspace_radius(n):
+    '''Frequencies of an unshifted FFT axis, normalized as make_Kspace_indices.m (1 at the half size)'''
+    half = n // 2 if n % 2 == 0 else (n - 1) // 2
+    return np.fft.fftfreq(n) * n / half if half else np.zeros(n)
+
+
+@functools.lru_cache(maxsize=32)
+def shell_index(shape, num_bins):
+    '''
+        Shell of every rfftn coefficient of an array of the given shape, and its weight.
+
+        Shells are [f_i, f_i+1) with f = linspace(0, 1, num_bins + 1) as FourierShellCorrelate.m;
+        coefficients outside all shells go to the extra bin num_bins. The rfftn half-spectrum
+        stands for both halves of the full one: coefficients whose mirror image is not stored
+        count twice.
+    '''
+    axes = [kspace_radius(n) for n in shape[:-1]]
+    last = kspace_radius(shape[-1])[:shape[-1] // 2 + 1]
+    grids = np.meshgrid(*axes, np.abs(last), indexing='ij')
+    Q = np.sqrt(sum(g ** 2 for g in grids))
+    edges = np.linspace(0, 1, num_bins + 1)
+    bins = np.searchsorted(edges, Q, side='right') - 1
+    bins[(bins < 0) | (bins >= num_bins)] = num_bins
+
+    weights = np.full(len(last), 2.)
+    weights[0] = 1.
+    if shape[-1] % 2 == 0:
+        weights[-1] = 1. # Nyquist column
+    weights = np.broadcast_to(weights, Q.shape)
+    return bins.ravel(), weights.ravel()
+
+
+def fourier_shell_correlate(obj1, obj2, num_bins=150, pix_size=None, ndim=2):
+    '''
+        FSC (ndim=3) or FRC (ndim=2) of pairs of objects.
+
+        One rfftn over the last ndim axes transforms all pairs, and every shell of every pair is
+        accumulated in a single np.bincount pass over a cached shell index.
+
+        Inputs:
+            obj1, obj2: (..., n1, ..., n_ndim) arrays of the same shape, leading axes are pairs
+            num_bins: number of spatial frequency shells
+            pix_size: scales the frequencies to 1 / (2 * pix_size) at the edge, as the MATLAB code
+        Outputs:
+            corr_coeffs: (..., num_bins), NaN for empty shells
+            spatial_frequency: (num_bins,) linspace(0, 1, num_bins), scaled with pix_size
+            mean_intensity: (..., num_bins) mean of |k1| + |k2| per shell
+    '''
+    obj1, obj2 = np.asarray(obj1, dtype=np.float64), np.asarray(obj2, dtype=np.float64)
+    if obj1.shape != obj2.shape:
+        raise ValueError("objects cannot be different sizes")
+    shape = obj1.shape[-ndim:]
+    batch = obj1.shape[:-ndim]
+    axes = tuple(range(-ndim, 0))
+    # the ifftshift/fftshift of my_fft.m only changes the phase of both spectra alike
+    k1 = np.fft.rfftn(obj1, axes=axes).reshape(-1, int(np.prod(shape[:-1])) * (shape[-1] // 2 + 1))
+    k2 = np.fft.rfftn(obj2, axes=axes).reshape(k1.shape)
+
+    bins, weights = shell_index(shape, num_bins)
+    n_pairs = k1.shape[0]
+    index = (bins[None] + (num_bins + 1) * np.arange(n_pairs)[:, None]).ravel()
+    length = n_pairs * (num_bins + 1)
+
+    def accumulate(values):
+        return np.bincount(index, (values * weights).ravel(), length).reshape(n_pairs, num_bins + 1)[:, :num_bins]
+
+    a1, a2 = np.abs(k1), np.abs(k2)
+    cross = accumulate((k1 * np.conj(k2)).real)
+    power = accumulate(a1 ** 2) * accumulate(a2 ** 2)
+    count = accumulate(np.ones_like(a1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr_coeffs = cross / np.sqrt(power)
+        mean_intensity = accumulate(a1 + a2) / count
+
+    spatial_frequency = np.linspace(0, 1, num_bins)
+    if pix_size is not None:
+        spatial_frequency = spatial_frequency / (2 * pix_size)
+    return corr_coeffs.reshape(batch + (num_bins,)), spatial_frequency, mean_intensity.reshape(batch + (num_bins,))
+
+
+def smooth(y, span=5):
+    '''MATLAB smooth(y) along the last axis: moving average, narrower at the ends, NaNs ignored'''
+    y = np.asarray(y, dtype=np.float64)
+    n = y.shape[-1]
+    valid = ~np.isnan(y)
+    values = np.where(valid, y, 0.)
+    csum = np.concatenate([np.zeros(y.shape[:-1] + (1,)), np.cumsum(values, -1)], -1)
+    ccount = np.concatenate([np.zeros(y.shape[:-1] + (1,)), np.cumsum(valid, -1)], -1)
+    i = np.arange(n)
+    half = np.minimum(np.minimum(i, n - 1 - i), (span - 1) // 2)
+    lo, hi = i - half, i + half + 1
+    with np.errstate(invalid='ignore'):
+        return (csum[..., hi] - csum[..., lo]) / (ccount[..., hi] - ccount[..., lo])
+
+
+def first_crossing(x, y, level):
+    '''x of the first crossing of y with a horizontal level, linear between samples (InterX), NaN if none'''
+    d = y - level
+    hits = np.nonzero((d[:-1] * d[1:] <= 0) & np.isfinite(d[:-1]) & np.isfinite(d[1:]))[0]
+    if not len(hits):
+        return np.nan
+    k = hits[0]
+    if d[k] == d[k + 1]:
+        return x[k]
+    return x[k] + (x[k + 1] - x[k]) * d[k] / (d[k] - d[k + 1])
+
+
+def resolution(im1, im2, threshold=0.143, num_bins=150):
+    '''
+        getFSC.m: half-bit resolution, in pixels, from one pair of images or a batch (..., H, W).
+
+        The pair is the even/odd subsampled im1[::2, ::2] and im2[1::2, 1::2] (getFSC's bicubic
+        imresize at scale 1 leaves them unchanged); the FRC is smoothed and its first crossing
+        with the threshold gives the resolution, 0 when the curve never crosses.
+    '''
+    im1, im2 = np.asarray(im1), np.asarray(im2)
+    a, b = im1[..., ::2, ::2], im2[..., 1::2, 1::2]
+    h, w = min(a.shape[-2], b.shape[-2]), min(a.shape[-1], b.shape[-1])
+    corr, freq, _ = fourier_shell_correlate(a[..., :h, :w], b[..., :h, :w], num_bins, pix_size=1)
+    corr = smooth(corr)
+    flat = corr.reshape(-1, num_bins)
+    crossings = np.array([first_crossing(freq, c, threshold) for c in flat])
+    with np.errstate(divide='ignore'):
+        out = np.where(np.isnan(crossings), 0., 1. / crossings)
+    return float(out[0]) if corr.ndim == 1 else out.reshape(corr.shape[:-1])
@@ -0,0 +1,155 @@
+# Independence map of a pattern set: Pearson correlation of every pixel pair, ordered by distance
+import argparse
+import functools
+
+import numpy as np
+import torch
+
+from dataset import load_mat
+
+
+def standardize(patterns, out=None, block_rows=4096):
+    '''
+        Pixels of a pattern stack with zero mean and unit norm across patterns, so the Pearson
+        correlation of two pixels is the dot product of their rows.
+
+        Inputs:
+            patterns: (n_pixels, n_patterns), may be memory-mapped, read in blocks of pixels
+            out: optional .npy path for a memory-mapped result, else in memory
+        Outputs:
+            (n_pixels, n_patterns) float32, pixels that never change are all zero (correlation 0)
+    '''
+    n_pixels, n_patterns = patterns.shape
+    if out is None:
+        Z = np.empty((n_pixels, n_patterns), dtype=np.float32)
+    else:
+        Z = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=(n_pixels, n_patterns))
+    for i in range(0, n_pixels, block_rows):
+        block = np.asarray(patterns[i:i + block_rows], dtype=np.float64)
+        block = block - block.mean(1, keepdims=True)
+        norm = np.sqrt((block ** 2).sum(1, keepdims=True))
+        Z[i:i + block_rows] = np.divide(block, norm, out=np.zeros_like(block), where=norm > 0)
+    return Z
+
+
+@functools.lru_cache(maxsize=8)
+def distance_ranks(side, max_rank=None):
+    '''
+        (dr, dc) offsets of the other pixels ordered by distance (ties by dr, then dc), shared by
+        every target of a side x side field of view.
+
+        Near a border some offsets fall outside the field of view and are skipped, so with
+        max_rank the list is cut where even a corner target keeps max_rank valid offsets.
+    '''
+    d = np.arange(-(side - 1), side)
+    dr, dc = np.meshgrid(d, d, indexing='ij')
+    dr, dc = dr.ravel(), dc.ravel()
+    order = np.lexsort((dc, dr, dr ** 2 + dc ** 2))[1:] # drop the target itself
+    offsets = np.stack([dr[order], dc[order]], 1)
+    if max_rank is not None and max_rank < side * side - 1:
+        # a corner target only keeps the offsets pointing into one quadrant
+        in_corner = np.cumsum((offsets[:, 0] >= 0) & (offsets[:, 1] >= 0))
+        # cut after a whole distance shell, every target then keeps at least as many as a corner
+        dist2 = (offsets ** 2).sum(1)
+        cut = np.searchsorted(in_corner, max_rank)
+        offsets = offsets[:np.searchsorted(dist2, dist2[cut], side='right')]
+    return offsets
+
+
+def independence_map(patterns, max_rank=None, budget=512., out=None, standardized=None):
+    '''
+        Pearson correlation of every target pixel with the other pixels, sorted by distance.
+
+        The pattern stack is standardized once; correlations are then (target block) x (source
+        window) matrix products, where a block is a run of target pixels and the window the image
+        rows within reach of the distance-rank index. The offsets are gathered in chunks, each
+        target filling its next free ranks, so the correlations, the block's slice of the map and
+        the index arithmetic of a chunk all stay within `budget`, whatever the field of view.
+
+        Inputs:
+            patterns: (n_pixels, n_patterns) with n_pixels = side^2, may be memory-mapped
+            max_rank: keep the max_rank nearest pixels of every target, None keeps all n_pixels - 1
+            budget: MiB for the correlations and indices of one block
+            out: optional .npy path, the map is written to a memory map there
+            standardized: optional .npy path for the standardized stack, else kept in memory
+        Outputs:
+            (n_ranks, n_pixels) float32, column t is the correlation vector of target pixel t
+    '''
+    n_pixels = patterns.shape[0]
+    side = int(round(np.sqrt(n_pixels)))
+    if side * side != n_pixels:
+        raise ValueError("%d pixels is not a square field of view" % n_pixels)
+    n_ranks = n_pixels - 1 if max_rank is None else min(max_rank, n_pixels - 1)
+
+    # three float64 copies of a block while standardizing
+    Z = standardize(patterns, standardized, block_rows=int(max(1, budget * 2 ** 20 // (24 * patterns.shape[1]))))
+    offsets = distance_ranks(side, max_rank)
+    reach = int(np.abs(offsets[:, 0]).max())
+    if out is None:
+        corr_map = np.empty((n_ranks, n_pixels), dtype=np.float32)
+    else:
+        corr_map = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=(n_ranks, n_pixels))
+
+    # half of the budget per target: correlations with its window (plus one image row, the
+    # block may span rows) and its slice of the map; the other half for the offset chunks,
+    # about 100 bytes per (target, offset) of index arithmetic and gathered temporaries
+    budget_bytes = budget * 2 ** 20
+    target_bytes = 4 * (min(2 * reach + 2, side) * side + side + n_ranks)
+    block = int(max(1, min(n_pixels, budget_bytes // 2 // target_bytes)))
+    chunk = int(max(1, min(len(offsets), budget_bytes // 2 // (100 * block))))
+    dr = torch.from_numpy(offsets[:, 0].astype(np.int32))
+    dc = torch.from_numpy(offsets[:, 1].astype(np.int32))
+
+    for t0 in range(0, n_pixels, block):
+        t1 = min(t0 + block, n_pixels)
+        targets = torch.arange(t0, t1, dtype=torch.int32)
+        rows, cols = (targets // side)[:, None], (targets % side)[:, None]
+        w0, w1 = max(0, t0 // side - reach), min(side, (t1 - 1) // side + reach + 1)
+        corr = torch.from_numpy(np.ascontiguousarray(Z[t0:t1])) @ \
+            torch.from_numpy(np.ascontiguousarray(Z[w0 * side:w1 * side])).t() # (block, window pixels)
+
+        values = torch.empty(t1 - t0, n_ranks)
+        filled = torch.zeros(t1 - t0, 1, dtype=torch.int32)
+        for o0 in range(0, len(offsets), chunk):
+            r = rows + dr[o0:o0 + chunk]
+            c = cols + dc[o0:o0 + chunk]
+            valid = (r >= 0) & (r < side) & (c >= 0) & (c < side)
+            # rank of every valid offset of a target, continuing from the previous chunks
+            rank = valid.cumsum(1, dtype=torch.int32).add_(filled - 1)
+            keep = valid & (rank < n_ranks)
+            hit, _ = keep.nonzero(as_tuple=True)
+            source = r[keep].sub_(w0).mul_(side).add_(c[keep])
+            values[hit, rank[keep].long()] = corr[hit, source.long()]
+            filled += valid.sum(1, keepdim=True, dtype=torch.int32)
+            if bool((filled >= n_ranks).all()):
+                break
+        corr_map[:, t0:t1] = values.t().numpy()
+    return corr_map
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Independence map of the illumination patterns')
+    parser.add_argument('filename', help='dataset with a Patterns (n_pixels, n_patterns) variable')
+    parser.add_argument('--out', default=None, help='.npy for the map, default <filename>_independence.npy')
+    parser.add_argument('--standardized', default=None,
+                        help='.npy for the memory-mapped standardized stack, default <out>_standardized.npy, '
+                             '"" keeps it in memory')
+    parser.add_argument('--max-rank', type=int, default=None, help='nearest pixels kept per target')
+    parser.add_argument('--budget', type=float, default=512., help='MiB per block of targets')
+    parser.add_argument('--threads', type=int, default=None, help='BLAS threads')
+    parser.add_argument('--png', action='store_true', help='also save the map as <out>.png')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    out = args.out or args.filename + '_independence.npy'
+    standardized = out[:-4] + '_standardized.npy' if args.standardized is None else args.standardized or None
+    corr_map = independence_map(load_mat(args.filename)['Patterns'], args.max_rank, args.budget, out, standardized)
+    print("saved %s, %d ranks x %d targets" % (out, corr_map.shape[0], corr_map.shape[1]))
+    if args.png:
+        import matplotlib.pyplot as plt
+        plt.imsave(out[:-4] + '.png', corr_map, cmap='viridis', vmin=-1, vmax=1)
+
+
+if __name__ == '__main__':
+    main()
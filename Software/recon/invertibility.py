@@ -0,0 +1,122 @@
+# Invertibility of a pattern set, port of calInvertibility.m
+import collections
+
+import numpy as np
+import scipy.linalg as sl
+import torch
+from pytorch_msssim import ssim
+
+from checkpoints import pattern_hash
+
+
+class Invertibility:
+    '''
+        SSIM between test images and their pseudo-inverse reconstruction from a pattern set.
+
+        calInvertibility.m computes rec = pinv(H2') * H2' * X, the projection of X onto the span
+        of the patterns, i.e. Q Q^T X for an orthonormal basis Q of that span. The basis is
+        factorized once and every score() is two thin products for a whole batch of images.
+
+            method='svd': Q from the singular vectors above rcond * s_max, exactly pinv's
+                rank cutoff; add/remove_patterns refactorize
+            method='qr': economic QR, add/remove_patterns update it in O(n_pixels * n_patterns)
+                (scipy.linalg.qr_insert / qr_delete); assumes the patterns are linearly
+                independent (n_patterns <= n_pixels, the compressive case)
+
+        SSIM uses pytorch_msssim (11x11 Gaussian window, sigma 1.5, data_range 1), which
+        averages over the valid positions of the window only, while MATLAB's ssim pads the
+        borders (replicate), so the scores differ from calInvertibility.m near the edges,
+        most for small images.
+
+        Inputs:
+            H2: (n_pixels, n_patterns) patterns as stored in the .mat files
+            image_shape: (nx, ny), images are flattened in C order to match the pattern pixels
+                (MATLAB's X(:) is column-major: pass X.T for images saved from MATLAB)
+            method: 'svd' or 'qr'
+            rcond: relative singular value cutoff, defaults to max(H2.shape) * eps as pinv
+    '''
+
+    def __init__(self, H2, image_shape, method='svd', rcond=None):
+        if method not in ('svd', 'qr'):
+            raise ValueError("unknown method %r" % method)
+        self.H2 = np.array(H2, dtype=np.float64)
+        self.image_shape = tuple(image_shape)
+        if self.H2.shape[0] != np.prod(self.image_shape):
+            raise ValueError("patterns have %d pixels, images %s" % (self.H2.shape[0], self.image_shape))
+        self.method = method
+        self.rcond = rcond
+        self._factorize()
+
+    def _factorize(self):
+        if self.method == 'svd':
+            U, s, _ = sl.svd(self.H2, full_matrices=False)
+            rcond = self.rcond if self.rcond is not None else max(self.H2.shape) * np.finfo(np.float64).eps
+            self.Q = U[:, s > rcond * s[0]] if len(s) else U
+        else:
+            self.Q, self.R = sl.qr(self.H2, mode='economic')
+
+    @property
+    def rank(self):
+        return self.Q.shape[1]
+
+    @property
+    def n_patterns(self):
+        return self.H2.shape[1]
+
+    def add_patterns(self, h, index=None):
+        '''h: (n_pixels,) or (n_pixels, k) new patterns inserted before column index (default: appended)'''
+        h = np.asarray(h, dtype=np.float64).reshape(self.H2.shape[0], -1)
+        index = self.n_patterns if index is None else index
+        self.H2 = np.insert(self.H2, [index], h, axis=1)
+        if self.method == 'svd':
+            self._factorize()
+        else:
+            self.Q, self.R = sl.qr_insert(self.Q, self.R, h, index, which='col')
+
+    def remove_patterns(self, indices):
+        '''indices: pattern columns to drop'''
+        indices = sorted(set(np.atleast_1d(indices).tolist()), reverse=True)
+        self.H2 = np.delete(self.H2, indices, axis=1)
+        if self.method == 'svd':
+            self._factorize()
+        else:
+            for k in indices:
+                self.Q, self.R = sl.qr_delete(self.Q, self.R, k, 1, which='col')
+
+    def reconstruct(self, X):
+        '''pinv(H2') * H2' * X for one (nx, ny) image or a stack (batch, nx, ny)'''
+        X = np.asarray(X, dtype=np.float64)
+        flat = X.reshape(-1, self.H2.shape[0]).T
+        return (self.Q @ (self.Q.T @ flat)).T.reshape(X.shape)
+
+    def score(self, X, data_range=1.):
+        '''SSIM of every image against its reconstruction, (batch,) or a float for a single image'''
+        X = np.asarray(X, dtype=np.float64)
+        rec = torch.from_numpy(self.reconstruct(X).reshape(-1, 1, *self.image_shape))
+        ref = torch.from_numpy(X.reshape(-1, 1, *self.image_shape))
+        values = ssim(rec, ref, data_range=data_range, size_average=False).numpy()
+        return float(values[0]) if X.ndim == 2 else values
+
+    __call__ = score
+
+
+# a few recent pattern sets only: every entry holds H2 and Q in float64
+_factorizations = collections.OrderedDict()
+MAX_CACHED = 2
+
+
+def calInvertibility(H2, X, method='svd'):
+    '''
+        Drop-in for calInvertibility.m, the factorization of H2 is cached by content for the
+        MAX_CACHED most recent pattern sets. To score many candidate subsets keep one
+        Invertibility and use add_patterns/remove_patterns instead.
+    '''
+    X = np.asarray(X)
+    key = (pattern_hash(np.asarray(H2)), X.shape[-2:], method)
+    if key in _factorizations:
+        _factorizations.move_to_end(key)
+    else:
+        _factorizations[key] = Invertibility(H2, X.shape[-2:], method)
+        while len(_factorizations) > MAX_CACHED:
+            _factorizations.popitem(last=False)
+    return _factorizations[key].score(X)
@@ -0,0 +1,70 @@
+# Stochastic pattern mini-batching for the data-fidelity term
+import torch
+
+
+class PatternSampler:
+    '''
+        Draws a mini-batch of pattern rows per step.
+
+        The data term is the mean squared residual over all patterns; (weighted) means over a
+        sampled batch are unbiased estimates of it:
+            'uniform': rows without replacement, plain mean over the batch
+            'importance': rows with replacement with p_i proportional to ||a_i||, each squared
+                residual weighted by 1 / (n_patterns * p_i)
+        The batch grows geometrically by `growth` every `grow_every` steps until it covers all
+        patterns; full_batch() switches to all patterns at once (used near convergence).
+
+        Inputs:
+            n_patterns: number of patterns
+            batch_size: initial batch size
+            sampling: 'uniform' or 'importance'
+            row_norms: (n_patterns,) tensor, needed for importance sampling
+            growth, grow_every: batch size schedule
+            device: device of the sampled indices
+            generator: optional torch.Generator for reproducible batches
+    '''
+
+    def __init__(self, n_patterns, batch_size, sampling='uniform', row_norms=None, growth=2.,
+                 grow_every=1000, device='cpu', generator=None):
+        if sampling not in ('uniform', 'importance'):
+            raise ValueError("unknown sampling %r" % sampling)
+        self.n_patterns = n_patterns
+        self.batch_size = min(batch_size, n_patterns)
+        self.sampling = sampling
+        self.growth = growth
+        self.grow_every = grow_every
+        self.device = torch.device(device)
+        self.generator = generator
+        self.full = self.batch_size >= n_patterns
+
+        if sampling == 'importance':
+            if row_norms is None:
+                raise ValueError("importance sampling needs the row norms of A")
+            probs = row_norms.float().to(self.device)
+            self.probs = probs / probs.sum()
+            self.inv_weights = 1. / (n_patterns * self.probs)
+
+    def current_batch_size(self, step):
+        if self.full:
+            return self.n_patterns
+        size = int(self.batch_size * self.growth ** (step // self.grow_every)) if self.grow_every else self.batch_size
+        return min(size, self.n_patterns)
+
+    def full_batch(self):
+        self.full = True
+
+    def sample(self, step):
+        '''
+            Outputs:
+                rows: (batch,) pattern indices on the device, or None for the full batch
+                weights: (batch,) per-row weights of the squared residuals, or None for a plain mean
+        '''
+        size = self.current_batch_size(step)
+        if size >= self.n_patterns:
+            self.full = True
+            return None, None
+        if self.sampling == 'uniform':
+            rows = torch.randperm(self.n_patterns, device=self.device, generator=self.generator)[:size]
+            return rows, None
+        rows = torch.multinomial(self.probs, size, replacement=True, generator=self.generator)
+        return rows, self.inv_weights.index_select(0, rows)
@@ -4,12 +4,94 @@ import torch
 from torch import nn
 import pdb
 import math
+import weakref
 
 import numpy as np
 
 import torch
 from torch import nn
 
+class _SineLinear(torch.autograd.Function):
+    '''
+        sin(x @ weight + bias) with a hand-written backward.
+
+        Only the input, the weight and the pre-activation are saved; the sine output and the
+        cos(z) * grad product are not kept by autograd. weight is (in, out) or, for ensembles,
+        (members, in, out) with x (members, N, in).
+    '''
+
+    @staticmethod
+    def forward(ctx, x, weight, bias):
+        if weight.dim() == 2:
+            z = torch.addmm(bias, x.reshape(-1, x.shape[-1]), weight).view(*x.shape[:-1], weight.shape[-1])
+        else:
+            z = torch.baddbmm(bias, x, weight)
+        ctx.save_for_backward(x, weight, z)
+        return torch.sin(z)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        x, weight, z = ctx.saved_tensors
+        # under autocast z is 16 bit: run the backward products in z's dtype, as autocast would,
+        # and return every gradient in the dtype of its input
+        grad_z = torch.cos(z).mul_(grad_output)
+        grad_x = grad_weight = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            grad_x = (grad_z @ weight.to(z.dtype).transpose(-1, -2)).to(x.dtype)
+        if weight.dim() == 2:
+            grad_z = grad_z.reshape(-1, grad_z.shape[-1])
+            x = x.reshape(-1, x.shape[-1])
+        if ctx.needs_input_grad[1]:
+            grad_weight = (x.to(z.dtype).transpose(-1, -2) @ grad_z).to(weight.dtype)
+        if ctx.needs_input_grad[2]:
+            grad_bias = grad_z.sum(-2, keepdim=weight.dim() == 3).to(weight.dtype)
+        return grad_x, grad_weight, grad_bias
+
+
+def _folded_sine_linear(x, weight, bias):
+    if weight.dim() == 2:
+        return torch.sin(torch.addmm(bias, x.reshape(-1, x.shape[-1]), weight).view(*x.shape[:-1], weight.shape[-1]))
+    return torch.sin(torch.baddbmm(bias, x, weight))
+
+
+_compiled_sine_linear = None
+
+
+def sine_linear(x, weight, bias, omega_0, mode='eager'):
+    '''
+        sin(omega_0 * (x @ weight + bias)) for weight (in, out) or ensemble weights (members, in, out).
+
+        mode:
+            'eager': the reference computation, omega_0 multiplies the activations
+            'fused': omega_0 is folded into weight and bias (an (in, out) multiply instead of an
+                (N, out) one) and the sine runs in _SineLinear, which keeps only what backward
+                needs. First order derivatives only.
+            'compile': the folded layer compiled with torch.compile; falls back to 'fused' if
+                compilation is not available
+    '''
+    global _compiled_sine_linear
+    if mode == 'eager':
+        if weight.dim() == 2:
+            return torch.sin(omega_0 * (x @ weight + bias))
+        return torch.sin(omega_0 * torch.baddbmm(bias, x, weight))
+
+    weight, bias = weight * omega_0, bias * omega_0
+    if mode == 'compile':
+        if _compiled_sine_linear is None:
+            try:
+                _compiled_sine_linear = torch.compile(_folded_sine_linear, dynamic=False)
+                return _compiled_sine_linear(x, weight, bias)
+            except Exception as e:
+                print("torch.compile unavailable (%s), using the fused autograd function" % e)
+                _compiled_sine_linear = False
+        if _compiled_sine_linear:
+            return _compiled_sine_linear(x, weight, bias)
+    elif mode != 'fused':
+        raise ValueError("unknown mode %r" % mode)
+    return _SineLinear.apply(x, weight, bias)
+
+
 class SineLayer(nn.Module):
     # See paper sec. 3.2, final paragraph, and supplement Sec. 1.5 for discussion of omega_0.
 
@@ -21,10 +103,11 @@ class SineLayer(nn.Module):
     # activations constant, but boost gradients to the weight matrix (see supplement Sec. 1.5)
 
     def __init__(self, in_features, out_features, bias=True,
-                 is_first=False, omega_0=30):
+                 is_first=False, omega_0=30, mode='eager'):
         super().__init__()
         self.omega_0 = omega_0
         self.is_first = is_first
+        self.mode = mode # see sine_linear
 
         self.in_features = in_features
         self.linear = nn.Linear(in_features, out_features, bias=bias)
@@ -42,7 +125,9 @@ class SineLayer(nn.Module):
                                             np.sqrt(6 / self.in_features) / self.omega_0)
 
     def forward(self, input):
-        return torch.sin(self.omega_0 * self.linear(input))
+        if self.mode == 'eager' or self.linear.bias is None:
+            return torch.sin(self.omega_0 * self.linear(input))
+        return sine_linear(input, self.linear.weight.t(), self.linear.bias, self.omega_0, self.mode)
 
     def forward_with_intermediate(self, input):
         # For visualization of activation distributions
@@ -52,17 +137,19 @@ class SineLayer(nn.Module):
 
 class Siren(nn.Module):
     def __init__(self, in_features, hidden_features, hidden_layers, out_features, outermost_linear=False,
-                 first_omega_0=30, hidden_omega_0=30.):
+                 first_omega_0=30, hidden_omega_0=30., mode='eager', need_input_grad=True):
         super().__init__()
+        # False skips the per-call copy of coords and input-gradient bookkeeping in autograd
+        self.need_input_grad = need_input_grad
 
         self.net = []
         self.net.append(SineLayer(in_features, hidden_features,
-                                  is_first=True, omega_0=first_omega_0))
+                                  is_first=True, omega_0=first_omega_0, mode=mode))
 
         # self.net.append(nn.Dropout(0.1))
         for i in range(hidden_layers):
             self.net.append(SineLayer(hidden_features, hidden_features,
-                                      is_first=False, omega_0=hidden_omega_0))
+                                      is_first=False, omega_0=hidden_omega_0, mode=mode))
 
 
         if outermost_linear:
@@ -79,18 +166,78 @@ class Siren(nn.Module):
 
         else:
             self.net.append(SineLayer(hidden_features, out_features,
-                                      is_first=False, omega_0=hidden_omega_0))
+                                      is_first=False, omega_0=hidden_omega_0, mode=mode))
 
         self.net = nn.Sequential(*self.net)
 
 
 
     def forward(self, coords):
-        coords = coords.clone().detach().requires_grad_(True) # allows to take derivative w.r.t. input
+        if self.need_input_grad:
+            coords = coords.clone().detach().requires_grad_(True) # allows to take derivative w.r.t. input
         output = self.net(coords)
         return output, coords
 
 
+class SirenEnsemble(nn.Module):
+    '''
+        K independently initialized Sirens trained as one batched model.
+
+        The weights of every layer are stacked along a leading member axis and applied
+        with a single batched matmul, so K restarts cost one forward/backward instead of K.
+        Members never interact: with an elementwise optimizer (Adam) and a loss that is
+        summed over members, each member follows exactly the trajectory it would have
+        followed on its own.
+    '''
+
+    def __init__(self, in_features, hidden_features, hidden_layers, out_features, num_members,
+                 outermost_linear=False, first_omega_0=30, hidden_omega_0=30., mode='eager',
+                 need_input_grad=True):
+        super().__init__()
+        self.num_members = num_members
+        self.mode = mode # see sine_linear
+        self.need_input_grad = need_input_grad
+        self.siren_kwargs = dict(in_features=in_features, hidden_features=hidden_features,
+                                 hidden_layers=hidden_layers, out_features=out_features,
+                                 outermost_linear=outermost_linear,
+                                 first_omega_0=first_omega_0, hidden_omega_0=hidden_omega_0)
+
+        # initialize every member exactly like a standalone Siren, then stack the weights
+        members = [Siren(**self.siren_kwargs) for _ in range(num_members)]
+
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        self.omegas = []
+        for layers in zip(*[m.net for m in members]):
+            linears = [l.linear if isinstance(l, SineLayer) else l for l in layers]
+            self.weights.append(nn.Parameter(torch.stack([l.weight.detach().t() for l in linears])))
+            self.biases.append(nn.Parameter(torch.stack([l.bias.detach() for l in linears]).unsqueeze(1)))
+            # None marks the outermost linear layer
+            self.omegas.append(layers[0].omega_0 if isinstance(layers[0], SineLayer) else None)
+
+    def forward(self, coords):
+        if self.need_input_grad:
+            coords = coords.clone().detach().requires_grad_(True) # allows to take derivative w.r.t. input
+        # (1, N, in) or (N, in) -> (K, N, in), shared by all members without a copy
+        x = coords.reshape(-1, coords.shape[-1]).expand(self.num_members, -1, -1)
+        for weight, bias, omega_0 in zip(self.weights, self.biases, self.omegas):
+            if omega_0 is None:
+                x = torch.baddbmm(bias, x, weight)
+            else:
+                x = sine_linear(x, weight, bias, omega_0, self.mode)
+        return x, coords
+
+    @torch.no_grad()
+    def member(self, k):
+        '''Return member k as a standalone Siren'''
+        siren = Siren(mode=self.mode, need_input_grad=self.need_input_grad, **self.siren_kwargs).to(self.weights[0].device)
+        linears = [l.linear if isinstance(l, SineLayer) else l for l in siren.net]
+        for linear, weight, bias in zip(linears, self.weights, self.biases):
+            linear.weight.copy_(weight[k].t())
+            linear.bias.copy_(bias[k, 0])
+        return siren
+
+
 class ReLULayer(nn.Module):
     '''
         Drop in replacement for SineLayer but with ReLU non linearity
@@ -138,25 +285,49 @@ class PosEncoding(nn.Module):
             self.num_frequencies = 4
 
         self.out_dim = in_features + 2 * in_features * self.num_frequencies
+        # coords @ freq_matrix gives 2^i * pi * c_j at column i * in_features + j
+        freq_bands = (2 ** torch.arange(self.num_frequencies, dtype=torch.float32)) * np.pi
+        freq_matrix = torch.zeros(in_features, self.num_frequencies * in_features)
+        for j in range(in_features):
+            freq_matrix[j, j::in_features] = freq_bands
+        self.register_buffer('freq_matrix', freq_matrix, persistent=False)
+        self._cache_ref, self._cache_version, self._cache = None, None, None
+
+    def __getstate__(self):
+        # the cached encoding holds a weak reference, which cannot be pickled
+        state = super().__getstate__()
+        state.update(_cache_ref=None, _cache_version=None, _cache=None)
+        return state
 
     def get_num_frequencies_nyquist(self, samples):
         nyquist_rate = 1 / (2 * (2 * 1 / samples))
         return int(math.floor(math.log(nyquist_rate, 2)))
 
     def forward(self, coords):
-        coords = coords.view(coords.shape[0], -1, self.in_features)
+        # the reconstruction grid is the same tensor at every step, reuse its encoding
+        if (not coords.requires_grad and self._cache_ref is not None and self._cache_ref() is coords
+                and self._cache_version == coords._version):
+            return self._cache
 
-        coords_pos_enc = coords
-        for i in range(self.num_frequencies):
-            for j in range(self.in_features):
-                c = coords[..., j]
+        coords_pos_enc = self.encode(coords)
 
-                sin = torch.unsqueeze(torch.sin((2 ** i) * np.pi * c), -1)
-                cos = torch.unsqueeze(torch.cos((2 ** i) * np.pi * c), -1)
+        if not coords.requires_grad:
+            self._cache_ref, self._cache_version, self._cache = weakref.ref(coords), coords._version, coords_pos_enc
+        return coords_pos_enc
+
+    def encode(self, coords):
+        coords = coords.view(coords.shape[0], -1, self.in_features)
 
-                coords_pos_enc = torch.cat((coords_pos_enc, sin, cos), axis=-1)
+        # one matmul for every frequency/dimension pair and a single sin and cos pass, written
+        # into the interleaved layout [c, sin(2^0 pi c_0), cos(2^0 pi c_0), sin(2^0 pi c_1), ...]
+        angles = coords @ self.freq_matrix.to(coords.dtype)
+        coords_pos_enc = coords.new_empty(coords.shape[0], coords.shape[1], self.out_dim)
+        coords_pos_enc[..., :self.in_features] = coords
+        sin_cos = coords_pos_enc[..., self.in_features:].unflatten(-1, (-1, 2))
+        sin_cos[..., 0] = torch.sin(angles)
+        sin_cos[..., 1] = torch.cos(angles)
 
-        return coords_pos_enc.reshape(coords.shape[0], -1, self.out_dim)
+        return coords_pos_enc
 
 
 class INR(nn.Module):
@@ -165,9 +336,11 @@ class INR(nn.Module):
                  out_features, outermost_linear=True,
                  first_omega_0=30, hidden_omega_0=30., scale=10.0,
                  pos_encode=True, sidelength=512, fn_samples=None,
-                 use_nyquist=True):
+                 use_nyquist=True, need_input_grad=True):
         super().__init__()
         self.pos_encode = pos_encode
+        # False skips the per-call copy of coords and input-gradient bookkeeping in autograd
+        self.need_input_grad = need_input_grad
 
         self.complex = False
         self.nonlin = ReLULayer
@@ -213,7 +386,8 @@ class INR(nn.Module):
         if self.pos_encode:
             coords = self.positional_encoding(coords)
 
-        coords = coords.clone().detach().requires_grad_(True)
+        if self.need_input_grad:
+            coords = coords.clone().detach().requires_grad_(True)
         output = self.net(coords)
 
         return output,coords
\ No newline at end of file
@@ -0,0 +1,108 @@
+# Coarse-to-fine reconstruction schedule
+import time
+from dataclasses import replace
+
+import numpy as np
+
+from utils import get_mgrid, psnr
+from reconstructor import Reconstructor
+
+
+def bin_patterns(patterns, image_size, factor, chunk=1024):
+    '''
+        Sum factor x factor pixel blocks of every pattern.
+
+        A map that is constant over each block gives the same measurements through the binned
+        patterns on the coarse grid as through the full patterns on the fine grid.
+
+        Inputs:
+            patterns: (image_size^2, n_patterns) in the .mat layout, may be memory-mapped
+        Outputs:
+            (coarse^2, n_patterns) float32 with coarse = image_size // factor
+    '''
+    coarse = image_size // factor
+    n_patterns = patterns.shape[1]
+    binned = np.empty((coarse * coarse, n_patterns), dtype=np.float32)
+    for j in range(0, n_patterns, chunk):
+        block = np.asarray(patterns[:, j:j + chunk], dtype=np.float32)
+        block = block.reshape(coarse, factor, coarse, factor, -1).sum((1, 3))
+        binned[:, j:j + chunk] = block.reshape(coarse * coarse, -1)
+    return binned
+
+
+def pooled_grid(image_size, factor):
+    '''Centres of the factor x factor blocks of the get_mgrid grid, (coarse^2, 2)'''
+    coarse = image_size // factor
+    return get_mgrid(image_size, 2).view(coarse, factor, coarse, factor, 2).mean((1, 3)).reshape(-1, 2)
+
+
+def coarse_to_fine(reconstructor, patterns, xrf, TXM, levels, level_steps, telemetry=None, reference=None,
+                   model=None, optim_state=None):
+    '''
+        Train the same Siren on coarser grids first, then continue on the full grid.
+
+        The network is continuous in the coordinates, so a model trained on a coarse grid is a
+        warm start for the next finer one. Every coarse level gets its own binned patterns and a
+        TXM prior resized to its grid; its coordinates are the centres of the fine pixel blocks.
+
+        Inputs:
+            reconstructor: Reconstructor of the full grid, with patterns and prior set
+            patterns: (n_pixels, n_patterns) as stored in the .mat files
+            xrf: (n_patterns,) or (n_patterns, n_elements)
+            TXM: raw TXM image
+            levels: coarse grid sizes, increasing, each dividing image_size
+            level_steps: steps per coarse level (the full grid runs config.total_steps)
+            telemetry: optional Telemetry of the full grid level
+            reference: optional ground truth in the layout of xhat, adds a PSNR per level
+            model, optim_state: optional SirenEnsemble and Adam state to start the first level from
+                (a checkpoint or a classical initialization), a new network by default
+
+        Outputs:
+            fit() result of the full grid, with 'levels': per level size, steps, stop reason,
+            time, data loss on its own grid and on the full grid, and PSNR against the reference
+    '''
+    cfg = reconstructor.config
+    if len(level_steps) == 1:
+        level_steps = list(level_steps) * len(levels)
+    compressed = reconstructor.prepare_measurements(xrf)
+    report = []
+
+    for size, steps in zip(levels, level_steps):
+        if cfg.image_size % size:
+            raise ValueError("level %d does not divide image_size %d" % (size, cfg.image_size))
+        factor = cfg.image_size // size
+        start = time.time()
+        level = Reconstructor(replace(cfg, image_size=size, total_steps=steps),
+                              bin_patterns(patterns, cfg.image_size, factor), TXM)
+        level.coords = pooled_grid(cfg.image_size, factor).unsqueeze(0).to(level.device)
+        result = level.fit(xrf, model=model, optim_state=optim_state)
+        model, optim_state = result["model"], None
+        report.append(level_report(reconstructor, model, compressed, result, size, time.time() - start, reference))
+
+    start = time.time()
+    result = reconstructor.fit(xrf, telemetry=telemetry, model=model)
+    report.append(level_report(reconstructor, result["model"], compressed, result, cfg.image_size,
+                               time.time() - start, reference))
+    result["levels"] = report
+    return result
+
+
+def level_report(reconstructor, model, compressed, result, size, seconds, reference=None):
+    full_loss = reconstructor.data_loss(model, compressed).cpu().numpy()
+    entry = {"size": size, "steps": result["steps"], "stop_reason": result["stop_reason"], "time": seconds,
+             "y_loss": float(result["y_loss"]), "y_loss_full": float(full_loss.min())}
+    if reference is not None:
+        n = reconstructor.config.image_size
+        output = reconstructor.evaluate(model, reconstructor.tiles())[int(np.argmin(full_loss))]
+        xhat = output.t().reshape(-1, n, n).cpu().numpy()
+        entry["psnr"] = float(np.mean([psnr(np.asarray(ref), x) for ref, x in zip(reference, xhat)]))
+    return entry
+
+
+def print_levels(report):
+    print("%8s %8s %10s %10s %12s %12s %10s" % ("grid", "steps", "stopped", "time [s]", "y_loss", "y_loss full",
+                                                 "PSNR [dB]"))
+    for entry in report:
+        print("%8s %8d %10s %10.1f %12.6g %12.6g %10s" % (
+            "%d^2" % entry["size"], entry["steps"], entry["stop_reason"], entry["time"], entry["y_loss"],
+            entry["y_loss_full"], "%.2f" % entry["psnr"] if "psnr" in entry else "-"))
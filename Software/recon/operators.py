@@ -0,0 +1,301 @@
+# Measurement operators: y = A x for the illumination patterns A
+import numpy as np
+import scipy.sparse as sps
+import torch
+from scipy.sparse.linalg import svds
+
+from precision import PrecisionPolicy
+
+
+def fold(x):
+    '''(..., n_pixels, k) -> (n_pixels, batch * k), plus what unfold() needs to undo it'''
+    return x.movedim(-2, 0).reshape(x.shape[-2], -1), (x.shape[:-2], x.shape[-1])
+
+
+def unfold(y, shape):
+    batch, k = shape
+    return y.view(y.shape[0], *batch, k).movedim(0, -2)
+
+
+class MeasurementOperator:
+    '''
+        Linear measurement operator A: (n_pixels) -> (n_patterns).
+
+        forward() takes x of shape (..., n_pixels, k), e.g. (restarts, pixels, elements), and is
+        differentiable w.r.t. x; adjoint() applies A^T to y of shape (..., n_patterns, k).
+        forward_rows(x, rows) only computes the rows (a 1-D index tensor) of A x, and row_norms()
+        returns ||a_i|| of every pattern, both used by pattern mini-batching.
+        Approximate operators report rel_error_2 and rel_error_fro, bounds of
+        ||A - A_approx|| / ||A|| in the spectral and Frobenius norms (0 for exact operators).
+    '''
+    n_patterns = None
+    n_pixels = None
+    rel_error_2 = 0.
+    rel_error_fro = 0.
+
+    def forward(self, x):
+        raise NotImplementedError
+
+    def adjoint(self, y):
+        raise NotImplementedError
+
+    def forward_rows(self, x, rows):
+        return self.forward(x).index_select(-2, rows)
+
+    def row_norms(self):
+        raise NotImplementedError
+
+    def __matmul__(self, x):
+        return self.forward(x)
+
+
+class DenseOperator(MeasurementOperator):
+    '''
+        The full (n_patterns, n_pixels) matrix resident on the device, optionally stored in 16 bits
+        through a PrecisionPolicy.
+    '''
+
+    def __init__(self, A, device='cpu', policy=None):
+        self.policy = policy if policy is not None else PrecisionPolicy(device=device)
+        # contiguous copy, also of a transposed read-only memory map
+        self.A = self.policy.store(torch.tensor(np.ascontiguousarray(A), dtype=torch.float32)).to(device)
+        self.n_patterns, self.n_pixels = self.A.shape
+
+    def forward(self, x):
+        return self.policy.project(self.A, x)
+
+    def adjoint(self, y):
+        y2, shape = fold(y)
+        return unfold(self.A.t().to(y.dtype) @ y2, shape)
+
+    def forward_rows(self, x, rows):
+        return self.policy.project(self.A.index_select(0, rows), x)
+
+    def row_norms(self):
+        return torch.linalg.vector_norm(self.A, dim=1, dtype=torch.float32)
+
+
+class AppendableOperator(MeasurementOperator):
+    '''
+        Dense operator that grows by pattern rows, for reconstructions during acquisition.
+
+        Rows live in a device buffer whose capacity doubles when full, so appending k rows costs
+        O(k n_pixels) amortized and forward() only touches the rows received so far.
+    '''
+
+    def __init__(self, n_pixels, device='cpu', policy=None, capacity=256):
+        self.policy = policy if policy is not None else PrecisionPolicy(device=device)
+        self.device = torch.device(device)
+        self.buffer = self.policy.store(torch.zeros(capacity, n_pixels)).to(self.device)
+        self.n_patterns, self.n_pixels = 0, n_pixels
+
+    @property
+    def A(self):
+        return self.buffer[:self.n_patterns]
+
+    def append(self, rows):
+        '''rows: (k, n_pixels) or (n_pixels,) new patterns'''
+        rows = torch.as_tensor(np.asarray(rows), dtype=torch.float32).reshape(-1, self.n_pixels)
+        needed = self.n_patterns + rows.shape[0]
+        if needed > self.buffer.shape[0]:
+            grown = self.buffer.new_zeros(max(needed, 2 * self.buffer.shape[0]), self.n_pixels)
+            grown[:self.n_patterns] = self.A
+            self.buffer = grown
+        self.buffer[self.n_patterns:needed] = self.policy.store(rows).to(self.device)
+        self.n_patterns = needed
+
+    def forward(self, x):
+        return self.policy.project(self.A, x)
+
+    def adjoint(self, y):
+        y2, shape = fold(y)
+        return unfold(self.A.t().to(y.dtype) @ y2, shape)
+
+    def forward_rows(self, x, rows):
+        return self.policy.project(self.A.index_select(0, rows), x)
+
+    def row_norms(self):
+        return torch.linalg.vector_norm(self.A, dim=1, dtype=torch.float32)
+
+
+class _StreamedProjection(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, op):
+        ctx.op = op
+        out = x.new_empty(op.n_patterns, x.shape[1])
+        for i, j, block in op.blocks(x.device):
+            torch.mm(block, x, out=out[i:j])
+        return out
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        grad_x = None
+        for i, j, block in ctx.op.blocks(grad_output.device):
+            part = block.t() @ grad_output[i:j]
+            grad_x = part if grad_x is None else grad_x.add_(part)
+        return grad_x, None
+
+
+class StreamingOperator(MeasurementOperator):
+    '''
+        Streams blocks of patterns from a host (typically memory-mapped) stack on every call.
+
+        Only chunk_rows patterns are on the device at a time and nothing is kept for backward,
+        so the pattern count is bounded by disk, not device memory. patterns has the .mat layout
+        (n_pixels, n_patterns).
+    '''
+
+    def __init__(self, patterns, chunk_rows=1024):
+        self.patterns = patterns
+        self.chunk_rows = chunk_rows
+        self.n_pixels, self.n_patterns = patterns.shape
+
+    def blocks(self, device):
+        for i in range(0, self.n_patterns, self.chunk_rows):
+            j = min(i + self.chunk_rows, self.n_patterns)
+            block = np.ascontiguousarray(self.patterns[:, i:j].T, dtype=np.float32)
+            yield i, j, torch.from_numpy(block).to(device, non_blocking=True)
+
+    def forward(self, x):
+        x2, shape = fold(x)
+        return unfold(_StreamedProjection.apply(x2, self), shape)
+
+    def adjoint(self, y):
+        y2, shape = fold(y)
+        out = None
+        for i, j, block in self.blocks(y.device):
+            part = block.t() @ y2[i:j]
+            out = part if out is None else out.add_(part)
+        return unfold(out, shape)
+
+    def forward_rows(self, x, rows):
+        # only the sampled patterns are read from the stack
+        cols = np.sort(rows.cpu().numpy())
+        block = torch.from_numpy(np.ascontiguousarray(self.patterns[:, cols].T, dtype=np.float32)).to(x.device)
+        order = torch.from_numpy(np.searchsorted(cols, rows.cpu().numpy())).to(x.device)
+        return torch.matmul(block.index_select(0, order), x)
+
+    def row_norms(self):
+        norms = torch.empty(self.n_patterns)
+        for i, j, block in self.blocks('cpu'):
+            norms[i:j] = torch.linalg.vector_norm(block, dim=1)
+        return norms
+
+
+class LowRankOperator(MeasurementOperator):
+    '''
+        Truncated SVD A ~ U diag(s) V^T (scipy.sparse.linalg.svds), applied as two thin products.
+
+        rel_error_2 = s_{rank+1} / s_1 is exact for the spectral norm; rel_error_fro is exact too,
+        from ||A||_F^2 - sum(s_i^2). svds computes at most min(A.shape) - 1 singular values, so
+        rank must stay below that; at rank = min(A.shape) - 1 s_{rank+1} is not available and
+        rel_error_2 is the upper bound ||A - A_rank||_F / s_1 instead.
+    '''
+
+    def __init__(self, A, rank, device='cpu'):
+        A = np.asarray(A, dtype=np.float64)
+        if not 1 <= rank < min(A.shape):
+            raise ValueError("lowrank operator needs 1 <= rank < %d for %d x %d patterns, got %d"
+                             % (min(A.shape), A.shape[0], A.shape[1], rank))
+        k = min(rank + 1, min(A.shape) - 1)
+        U, s, Vt = svds(A, k=k)
+        order = np.argsort(s)[::-1]
+        U, s, Vt = U[:, order], s[order], Vt[order]
+
+        self.rank = rank
+        self.U = torch.as_tensor(U[:, :self.rank], dtype=torch.float32).to(device)
+        self.s = torch.as_tensor(s[:self.rank], dtype=torch.float32).to(device)
+        self.Vt = torch.as_tensor(Vt[:self.rank], dtype=torch.float32).to(device)
+        self.n_patterns, self.n_pixels = A.shape
+
+        norm_fro2 = float(np.sum(A ** 2))
+        residual_fro2 = max(norm_fro2 - np.sum(s[:self.rank] ** 2), 0.)
+        # s_1 of the full matrix is the largest value svds returned
+        if self.rank < len(s):
+            self.rel_error_2 = float(s[self.rank] / s[0])
+        else:
+            self.rel_error_2 = float(np.sqrt(residual_fro2) / s[0])
+        self.rel_error_fro = float(np.sqrt(residual_fro2 / norm_fro2))
+
+    def forward(self, x):
+        x2, shape = fold(x)
+        return unfold(self.U @ (self.s[:, None] * (self.Vt @ x2)), shape)
+
+    def adjoint(self, y):
+        y2, shape = fold(y)
+        return unfold(self.Vt.t() @ (self.s[:, None] * (self.U.t() @ y2)), shape)
+
+    def forward_rows(self, x, rows):
+        x2, shape = fold(x)
+        return unfold(self.U.index_select(0, rows) @ (self.s[:, None] * (self.Vt @ x2)), shape)
+
+    def row_norms(self):
+        return torch.linalg.vector_norm(self.U * self.s, dim=1)
+
+
+class SparseOperator(MeasurementOperator):
+    '''
+        Keeps the largest-magnitude entries of A (a fraction `density` of them) as a sparse CSR
+        matrix. The Frobenius error is exact from the dropped entries and also bounds the spectral
+        error, relative to ||A||_2 computed by svds.
+    '''
+
+    def __init__(self, A, density=0.1, device='cpu'):
+        A = np.asarray(A, dtype=np.float32)
+        self.n_patterns, self.n_pixels = A.shape
+        keep = max(1, int(round(density * A.size)))
+        flat = np.abs(A).ravel()
+        threshold = np.partition(flat, flat.size - keep)[flat.size - keep]
+        kept = sps.csr_matrix(np.where(np.abs(A) >= threshold, A, 0))
+        self.density = kept.nnz / A.size
+
+        self.A = torch.sparse_csr_tensor(torch.from_numpy(kept.indptr.astype(np.int64)),
+                                         torch.from_numpy(kept.indices.astype(np.int64)),
+                                         torch.from_numpy(kept.data), size=A.shape).to(device)
+        self.At = self.A.to_sparse_coo().t().to_sparse_csr()
+
+        norm_fro2 = float(np.sum(A.astype(np.float64) ** 2))
+        dropped_fro = np.sqrt(max(norm_fro2 - float(np.sum(kept.data.astype(np.float64) ** 2)), 0.))
+        norm_2 = svds(A.astype(np.float64), k=1, return_singular_vectors=False)[0]
+        self.rel_error_fro = float(dropped_fro / np.sqrt(norm_fro2))
+        self.rel_error_2 = float(dropped_fro / norm_2)
+
+    def forward(self, x):
+        x2, shape = fold(x)
+        return unfold(self.A @ x2, shape)
+
+    def adjoint(self, y):
+        y2, shape = fold(y)
+        return unfold(self.At @ y2, shape)
+
+    def row_norms(self):
+        lengths = self.A.crow_indices().diff()
+        rows = torch.repeat_interleave(torch.arange(self.n_patterns, device=lengths.device), lengths)
+        return torch.zeros(self.n_patterns, device=lengths.device).index_add_(0, rows, self.A.values() ** 2).sqrt()
+
+
+def build_operator(patterns, kind='dense', device='cpu', policy=None, rank=None, density=None, chunk_rows=1024):
+    '''
+        Operator for patterns in the .mat layout (n_pixels, n_patterns).
+
+        kind: 'dense', 'stream', 'lowrank' (needs rank) or 'sparse' (needs density)
+
+        Only the dense operator stores A in the 16-bit formats of policy, the others are float32.
+    '''
+    if kind not in ('dense', 'stream', 'lowrank', 'sparse'):
+        raise ValueError("unknown operator %r" % kind)
+    if kind != 'dense' and policy is not None and policy.storage != 'fp32':
+        raise ValueError("pattern storage %s is only supported by the dense operator, not %r" % (policy.storage, kind))
+    if kind == 'lowrank' and rank is None:
+        raise ValueError("the lowrank operator needs a rank (operator_rank / --operator-rank)")
+    if kind == 'sparse' and (density is None or not 0 < density <= 1):
+        raise ValueError("the sparse operator needs a density in (0, 1] (operator_density / --operator-density)")
+    if kind == 'stream':
+        return StreamingOperator(patterns, chunk_rows)
+    A = np.asarray(patterns, dtype=np.float32).T
+    if kind == 'dense':
+        return DenseOperator(A, device, policy)
+    if kind == 'lowrank':
+        return LowRankOperator(A, rank, device)
+    return SparseOperator(A, density, device)
@@ -0,0 +1,99 @@
+# Mixed and low precision policy for the reconstruction loop
+import contextlib
+
+import torch
+
+DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def bf16_supported(device):
+    '''True when bf16 math runs natively (cuda with bf16 support, or a cpu oneDNN has bf16 kernels for)'''
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    # get_cpu_capability() only reports the vector ISA level (AVX2, AVX512), not bf16 support
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+class _LowPrecisionProjection(torch.autograd.Function):
+    '''
+        A @ x for a 16-bit A with float32 accumulation.
+
+        A is upcast one block of rows at a time, so no float32 copy of A is ever resident, and
+        only the 16-bit A is kept for backward.
+    '''
+
+    @staticmethod
+    def forward(ctx, A, x, chunk_rows):
+        ctx.save_for_backward(A)
+        ctx.chunk_rows = chunk_rows
+        out = x.new_empty(A.shape[0], x.shape[1])
+        for i in range(0, A.shape[0], chunk_rows):
+            torch.mm(A[i:i + chunk_rows].float(), x, out=out[i:i + chunk_rows])
+        return out
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        A, = ctx.saved_tensors
+        grad_x = None
+        for i in range(0, A.shape[0], ctx.chunk_rows):
+            part = A[i:i + ctx.chunk_rows].float().t() @ grad_output[i:i + ctx.chunk_rows]
+            grad_x = part if grad_x is None else grad_x.add_(part)
+        return None, grad_x, None
+
+
+class PrecisionPolicy:
+    '''
+        Precision of the network (compute) and of the pattern matrix (storage).
+
+        compute='bf16' or 'fp16' runs the Siren forward under autocast; the parameters, the
+        optimizer state and everything after the network (projection, losses) stay float32, so the
+        parameters are the float32 master copy. 'fp16' also uses a GradScaler (loss scaling).
+        storage='bf16' or 'fp16' keeps A in 16 bits and projects with float32 accumulation.
+
+        Inputs:
+            compute: 'fp32', 'bf16' or 'fp16'
+            storage: 'fp32', 'bf16' or 'fp16'
+            device: torch device of the reconstruction
+            chunk_rows: pattern rows upcast at a time by the low precision projection
+    '''
+
+    def __init__(self, compute='fp32', storage='fp32', device='cpu', chunk_rows=4096):
+        if compute not in DTYPES or storage not in DTYPES:
+            raise ValueError("precision must be one of %s" % ', '.join(DTYPES))
+        self.device = torch.device(device)
+        self.compute = compute
+        self.storage = storage
+        self.chunk_rows = chunk_rows
+        if compute == 'bf16' and not bf16_supported(self.device):
+            print("bf16 is emulated on this %s, expect it to be slower than fp32" % self.device.type)
+        if compute == 'fp16' and self.device.type != 'cuda':
+            raise ValueError("fp16 compute needs cuda, use bf16 on cpu")
+
+    def autocast(self):
+        if self.compute == 'fp32':
+            return contextlib.nullcontext()
+        return torch.autocast(self.device.type, dtype=DTYPES[self.compute])
+
+    def grad_scaler(self):
+        '''GradScaler for fp16 compute, else None'''
+        if self.compute == 'fp16':
+            return torch.amp.GradScaler(self.device.type)
+        return None
+
+    def store(self, A):
+        return A.to(DTYPES[self.storage])
+
+    def project(self, A, x):
+        '''A: (n_patterns, n_pixels) as returned by store(), x: (..., n_pixels, k) float32'''
+        if A.dtype == torch.float32:
+            return A @ x
+        # fold the leading batch dimensions into the columns: one (n_pixels, batch * k) product
+        batch = x.shape[:-2]
+        x2 = x.movedim(-2, 0).reshape(x.shape[-2], -1)
+        out = _LowPrecisionProjection.apply(A, x2, self.chunk_rows)
+        return out.view(A.shape[0], *batch, x.shape[-1]).movedim(0, -2)
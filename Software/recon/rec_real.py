@@ -1,113 +1,212 @@
 # Reconstruction of fluorescence map
-from datetime import datetime
+import argparse
+import os
 
 import numpy as np
-import torch
-from PIL import Image
-from matplotlib import pyplot as plt
-from pytorch_msssim import ssim
-from scipy.io import loadmat, savemat
-from torch import nn
-from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts
-from torch.utils.data import DataLoader, Dataset
-from torchvision.transforms import Resize, ToTensor, Compose, Normalize
-from torchvision.utils import make_grid
-
-from utils import CompressiveImagingReal,gradient_loss
-from model import Siren, INR
-from skimage import filters
-import wandb
-
-image_size = 128
-filename = 'data4rec_real_2021_07_mixed_particles_NMC_LCO_LNO'
-element = 'Ni'
-
-loss_re, recons_re = [],[]
-# load measurement matrix
-A = loadmat(filename + '.mat')['Patterns']
-A = torch.from_numpy(A).to(torch.float32)
-A = torch.transpose(A, 0,1)
-# load the XRF measurement
-compressed = loadmat(filename + '.mat')['XRF_amount_'+element]
-compressed = torch.from_numpy(compressed).to(torch.float32).T
-alpha = 8 # may be tuned for better performance, there is a scalling inconsistence (to be explored)
-compressed = torch.squeeze(compressed)*alpha
-# load the TXM image
-TXM = loadmat(filename + '.mat')['TXM']
-TXM = Image.fromarray(TXM)
-transform = Compose([
-    Resize(image_size),
-    ToTensor(),
-    # Normalize(torch.Tensor([0.5]), torch.Tensor([0.5]))
-])
-TXM = transform(TXM)
-TXM = torch.transpose(TXM,1,2)
-data = CompressiveImagingReal(image_size, TXM)
-dataloader = DataLoader(data, batch_size=1, pin_memory=True, num_workers=0)
-model_input, TXM = next(iter(dataloader))
-model_input, TXM, compressed, A = model_input.cuda(),TXM.cuda(),compressed.cuda(), A.cuda()
-
-total_steps = 20000
-steps_til_summary = 1000
-num_restarts = 1
-exit_window = 50
-
-psnr_list = []
-taskname = "rec_" + filename + "_hidden_feature_1024_layer_5_lr_5e-6_lambda_1e-5"
-wandb.init(project="RealExp",name=taskname)
-
-for j in range(num_restarts):
-
-    img_siren = Siren(in_features=2, out_features=1, hidden_features=1024,  #### related to noise level
-                      hidden_layers=5, outermost_linear=True)
-    img_siren = img_siren.cuda()
-
-    optim = torch.optim.Adam(lr=5e-6, params=img_siren.parameters()) # important parameter
-    # optim = torch.optim.AdamW(img_siren.parameters(), lr=sampling_ratio * 1e-5)
-
-    loss_iter = []
-    recons_iter = []
-
-    for i in range(total_steps):
-
-        model_output, coords = img_siren(model_input)
-        # model_output = torch.clip(model_output, 0, torch.inf)
-        model_output_vec = torch.flatten(torch.transpose(model_output,1,2))
-        compressed_out = A @ model_output_vec
-
-        y_loss = ((compressed_out - compressed) ** 2).mean()
-        loss = y_loss + 1e-5*gradient_loss(model_output.view(image_size, image_size),
-                                             TXM.view(image_size, image_size)) # important parameter
-
-        if i >= total_steps - exit_window:
-            recons_iter.append(model_output.cpu().detach().numpy())
-            loss_iter.append(loss.cpu().detach().numpy())
-
-        if not i % steps_til_summary:
-            print("Step %d, Total loss %0.6f" % (i, loss))
-            wandb.log({'loss': loss})
-            imglist = [model_output.view(image_size, image_size).t(),TXM.view(image_size, image_size).t()]
-            image_array = torch.cat(imglist, 1)
-            images = wandb.Image(
-                image_array,
-                caption="Recon, TXM"
-            )
-            wandb.log({"examples": images})
-            #np.save('process/'+element+'_itr_'+str(i)+'.npy',model_output.view(image_size, image_size).t().cpu().detach().numpy())
-
-        optim.zero_grad()
-        loss.backward()
-        optim.step()
-
-    idx_itr = np.argmin(loss_iter, axis=0)
-    recons_re.append(recons_iter[idx_itr][0])
-    loss_re.append(y_loss.data.cpu().numpy())
-
-idx_re = np.argmin(loss_re, axis=0)
-x_hat = np.reshape(recons_re[idx_re],(image_size,image_size))
-
-mdic = {"xhat": x_hat, "TXM": TXM.cpu().detach().numpy(), "y": compressed.cpu().detach().numpy(), "A": A.cpu().detach().numpy()}
-
-savemat(taskname+".mat", mdic)
-
-
+from scipy.io import savemat
+
+from utils import load_real_data
+from reconstructor import ReconConfig, Reconstructor
+from multires import coarse_to_fine, print_levels
+from checkpoints import CheckpointStore, pattern_hash
+from solvers import SOLVERS, build_solver, initial_model
+from telemetry import Telemetry, PrintSink, JsonlSink, SnapshotSink, WandbSink
+
+
+def get_taskname(filename, elements, cfg, solver='inr'):
+    if solver != 'inr':
+        return "rec_%s_%s_%s" % (filename, "_".join(elements), solver)
+    return "rec_%s_%s_hidden_feature_%d_layer_%d_lr_%g_lambda_%g" % (
+        filename, "_".join(elements), cfg.hidden_features, cfg.hidden_layers, cfg.lr, cfg.tv_weight)
+
+
+def solver_options(name, args, cfg):
+    if name == 'tikhonov':
+        return {"lam": args.solver_lambda}
+    if name in ('cg', 'lsqr'):
+        return {"lam": args.solver_lambda, "iterations": args.solver_iterations}
+    return {"tv_weight": cfg.tv_weight, "iterations": args.solver_iterations}
+
+
+def build_telemetry(args, taskname, cfg):
+    sinks = [PrintSink()]
+    if args.log_dir:
+        sinks.append(JsonlSink(os.path.join(args.log_dir, taskname, 'metrics.jsonl')))
+        sinks.append(SnapshotSink(os.path.join(args.log_dir, taskname, 'snapshots')))
+    if args.wandb:
+        sinks.append(WandbSink(args.project, taskname, cfg.to_dict(), mode=args.wandb_mode, dir=args.log_dir))
+    return Telemetry(sinks, min_interval=args.min_interval, profile_every=args.profile_every)
+
+
+def parse_args():
+    defaults = ReconConfig()
+    parser = argparse.ArgumentParser(description='Reconstruct elemental maps from structured illumination XRF data')
+    parser.add_argument('filenames', nargs='*', default=['data4rec_real_2021_07_mixed_particles_NMC_LCO_LNO'],
+                        help='datasets (.mat without extension), reconstructed one after another')
+    parser.add_argument('--elements', nargs='+', default=['Ni'],
+                        help='XRF_amount_<element> to fit, several (e.g. Ni Co Mn) are fitted in the same pass')
+    parser.add_argument('--image-size', type=int, default=defaults.image_size)
+    parser.add_argument('--hidden-features', type=int, default=defaults.hidden_features)
+    parser.add_argument('--hidden-layers', type=int, default=defaults.hidden_layers)
+    parser.add_argument('--siren-mode', default=defaults.siren_mode, choices=['eager', 'fused', 'compile'],
+                        help='eager is the reference, fused/compile fold omega_0 and fuse the sine')
+    parser.add_argument('--precision', default=defaults.precision, choices=['fp32', 'bf16', 'fp16'],
+                        help='network compute precision (autocast), fp16 needs cuda')
+    parser.add_argument('--pattern-dtype', default=defaults.pattern_dtype, choices=['fp32', 'bf16', 'fp16'],
+                        help='storage of the pattern matrix, projected with float32 accumulation')
+    parser.add_argument('--operator', default=defaults.operator, choices=['dense', 'stream', 'lowrank', 'sparse'],
+                        help='measurement operator: dense matrix, patterns streamed from the memory map, '
+                             'truncated SVD or sparsified A')
+    parser.add_argument('--operator-rank', type=int, default=None, help='rank of the lowrank operator')
+    parser.add_argument('--operator-density', type=float, default=None,
+                        help='fraction of entries kept by the sparse operator')
+    parser.add_argument('--operator-chunk', type=int, default=defaults.operator_chunk,
+                        help='patterns per streamed block')
+    parser.add_argument('--pattern-batch', type=int, default=None,
+                        help='patterns sampled per step for the data term (default: all)')
+    parser.add_argument('--pattern-sampling', default=defaults.pattern_sampling, choices=['uniform', 'importance'])
+    parser.add_argument('--pattern-batch-growth', type=float, default=defaults.pattern_batch_growth)
+    parser.add_argument('--pattern-batch-every', type=int, default=defaults.pattern_batch_every)
+    parser.add_argument('--tile-budget', type=float, default=None,
+                        help='MiB of network activations per pass, evaluates the grid in chunks (default: whole grid)')
+    parser.add_argument('--levels', type=int, nargs='+', default=None,
+                        help='coarse grid sizes trained first, e.g. 32 64 (coarse-to-fine)')
+    parser.add_argument('--level-steps', type=int, nargs='+', default=[2000],
+                        help='steps per coarse level, one value for all levels')
+    parser.add_argument('--checkpoints', default=None,
+                        help='store trained networks here and warm-start from the nearest compatible one')
+    parser.add_argument('--checkpoint-budget', type=float, default=2048., help='MiB kept in --checkpoints (LRU)')
+    parser.add_argument('--cold-start', action='store_true', help='only save to --checkpoints, start from random weights')
+    parser.add_argument('--solver', default='inr', choices=['inr'] + list(SOLVERS),
+                        help='inr trains the Siren, the others are the classical solvers of solvers.py')
+    parser.add_argument('--init-solver', default=None, choices=list(SOLVERS),
+                        help='start the Siren from this classical solution')
+    parser.add_argument('--init-steps', type=int, default=500, help='steps fitting the Siren to --init-solver')
+    parser.add_argument('--init-lr', type=float, default=1e-4, help='learning rate fitting the Siren to --init-solver')
+    parser.add_argument('--solver-lambda', type=float, default=0., help='Tikhonov weight of tikhonov, cg and lsqr, against the mean data term')
+    parser.add_argument('--solver-iterations', type=int, default=200)
+    parser.add_argument('--lr', type=float, default=defaults.lr)
+    parser.add_argument('--tv-weight', type=float, default=defaults.tv_weight)
+    parser.add_argument('--alpha', type=float, default=defaults.alpha)
+    parser.add_argument('--steps', type=int, default=defaults.total_steps)
+    parser.add_argument('--summary', type=int, default=defaults.steps_til_summary)
+    parser.add_argument('--restarts', type=int, default=defaults.num_restarts)
+    parser.add_argument('--exit-window', type=int, default=defaults.exit_window,
+                        help='return the best iterate of the last N steps, 0 tracks the whole run')
+    parser.add_argument('--ema-decay', type=float, default=None,
+                        help='also save a Polyak-averaged reconstruction (e.g. 0.99)')
+    parser.add_argument('--no-early-stopping', dest='early_stopping', action='store_false',
+                        help='always run --steps iterations')
+    parser.add_argument('--converge-window', type=int, default=defaults.converge_window)
+    parser.add_argument('--converge-rtol', type=float, default=defaults.converge_rtol)
+    parser.add_argument('--converge-patience', type=int, default=defaults.converge_patience)
+    parser.add_argument('--min-steps', type=int, default=defaults.min_steps)
+    parser.add_argument('--noise-level', default=None,
+                        help="'poisson' or std of a raw XRF value, stops once the residual reaches the noise floor")
+    parser.add_argument('--device', default=None, help='cuda, cpu, ... (default: cuda when available)')
+    parser.add_argument('--threads', type=int, default=None, help='torch threads on cpu')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--log-dir', default=None,
+                        help='write metrics.jsonl and PNG/NPY snapshots to <log-dir>/<taskname>')
+    parser.add_argument('--wandb', action='store_true', help='log to wandb')
+    parser.add_argument('--wandb-mode', default='online', choices=['online', 'offline'],
+                        help='offline writes a local run directory, sync it later with `wandb sync`')
+    parser.add_argument('--project', default='RealExp', help='wandb project')
+    parser.add_argument('--min-interval', type=float, default=0., help='minimum seconds between two log records')
+    parser.add_argument('--profile-every', type=int, default=100, help='time the step phases every N steps, 0 disables')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cfg = ReconConfig(image_size=args.image_size, hidden_features=args.hidden_features,
+                      hidden_layers=args.hidden_layers, siren_mode=args.siren_mode,
+                      precision=args.precision, pattern_dtype=args.pattern_dtype,
+                      operator=args.operator, operator_rank=args.operator_rank,
+                      operator_density=args.operator_density, operator_chunk=args.operator_chunk,
+                      pattern_batch=args.pattern_batch, pattern_sampling=args.pattern_sampling,
+                      pattern_batch_growth=args.pattern_batch_growth, pattern_batch_every=args.pattern_batch_every,
+                      tile_budget=args.tile_budget,
+                      lr=args.lr, tv_weight=args.tv_weight,
+                      alpha=args.alpha, total_steps=args.steps, steps_til_summary=args.summary,
+                      num_restarts=args.restarts, exit_window=args.exit_window, ema_decay=args.ema_decay,
+                      early_stopping=args.early_stopping, converge_window=args.converge_window,
+                      converge_rtol=args.converge_rtol, converge_patience=args.converge_patience,
+                      min_steps=args.min_steps,
+                      noise_level=args.noise_level if args.noise_level in (None, 'poisson') else float(args.noise_level),
+                      device=args.device, num_threads=args.threads, seed=args.seed)
+    reconstructor = Reconstructor(cfg)
+    store = None
+    if args.checkpoints:
+        store = CheckpointStore(args.checkpoints, max_bytes=int(args.checkpoint_budget * 2 ** 20))
+    report = []
+    for filename in args.filenames:
+        A, xrf, TXM = load_real_data(filename, args.elements)
+        reconstructor.set_patterns(A)
+        if reconstructor.op.rel_error_2:
+            print("%s operator, relative error bounds: spectral %.3g, Frobenius %.3g"
+                  % (cfg.operator, reconstructor.op.rel_error_2, reconstructor.op.rel_error_fro))
+        reconstructor.set_prior(TXM)
+
+        taskname = get_taskname(filename, args.elements, cfg, args.solver)
+        telemetry = build_telemetry(args, taskname, cfg)
+        model, optim_state = None, None
+        # the classical solvers do not train the Siren, a warm start would be ignored
+        if store is not None and args.solver == 'inr':
+            patterns_id = pattern_hash(A)
+            entry = None if args.cold_start else store.nearest(patterns_id, cfg.image_size, args.elements, cfg)
+            if entry is not None:
+                model = reconstructor.build_model(len(args.elements))
+                optim_state, info = store.load(entry, model, reconstructor.device)
+                print("warm start from %s (%d^2, %s)" % (entry, info["image_size"], info.get("source", "?")))
+
+        init_solver = args.solver if args.solver != 'inr' else args.init_solver
+        if init_solver is not None and model is None:
+            solver = build_solver(init_solver, reconstructor.op, cfg.image_size, **solver_options(init_solver, args, cfg))
+            solution = solver.solve(reconstructor.prepare_measurements(xrf), reconstructor.TXM)
+            print("%s: y_loss %0.6f, %d iterations, %.1f s" % (init_solver, solution["y_loss"], solution["iterations"],
+                                                              solution["time"]))
+            if args.solver == 'inr':
+                model = initial_model(reconstructor, solution["xhat"], args.init_steps, args.init_lr)
+
+        if args.solver != 'inr':
+            result = dict(solution, xhat_ema=None, steps=solution["iterations"], stop_reason=args.solver)
+        elif args.levels:
+            result = coarse_to_fine(reconstructor, A, xrf, TXM, args.levels, args.level_steps, telemetry=telemetry,
+                                    model=model, optim_state=optim_state)
+            print_levels(result["levels"])
+        else:
+            result = reconstructor.fit(xrf, telemetry=telemetry, model=model, optim_state=optim_state)
+        if store is not None and args.solver == 'inr':
+            store.save(patterns_id, cfg.image_size, args.elements, cfg, result["model"], result["optimizer"],
+                       source=filename, steps=result["steps"], y_loss=float(result["y_loss"]))
+        timing = telemetry.close()
+        if telemetry.dropped:
+            print("telemetry dropped %d records" % telemetry.dropped)
+        print("mean step time [ms]: " + ", ".join("%s %.2f" % (k, v) for k, v in timing.items()))
+        x_hat = result["xhat"] # (n_elements, image_size, image_size)
+
+        mdic = {"xhat": x_hat[0] if len(args.elements) == 1 else x_hat, "elements": args.elements,
+                "TXM": reconstructor.TXM.cpu().numpy(),
+                "y": reconstructor.prepare_measurements(xrf).cpu().numpy()}
+        if cfg.operator == 'dense':
+            # the other operators exist to avoid holding the full pattern matrix
+            mdic["A"] = np.asarray(A, dtype=np.float32).T
+        for k, element in enumerate(args.elements):
+            mdic["xhat_" + element] = x_hat[k]
+        if result["xhat_ema"] is not None:
+            for k, element in enumerate(args.elements):
+                mdic["xhat_ema_" + element] = result["xhat_ema"][k]
+        mdic["steps"], mdic["stop_reason"] = result["steps"], result["stop_reason"]
+        savemat(taskname + ".mat", mdic)
+        print("Saved %s.mat, y_loss %0.6f, %d steps (%s), %.1f s" % (
+            taskname, result["y_loss"], result["steps"], result["stop_reason"], result["time"]))
+        report.append((filename, result["steps"], result["stop_reason"], result["time"]))
+
+    print("%-60s %8s %10s %10s" % ("dataset", "steps", "stopped", "time [s]"))
+    for filename, steps, reason, seconds in report:
+        print("%-60s %8d %10s %10.1f" % (filename, steps, reason, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+# Reusable reconstruction engine for fluorescence maps
+import time
+from dataclasses import dataclass, asdict
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.transforms import Resize, ToTensor, Compose
+
+from utils import get_mgrid, gradient_loss
+from model import SirenEnsemble
+from convergence import BestIterateTracker, ConvergenceMonitor, residual_target
+from telemetry import StepTimer
+from precision import PrecisionPolicy
+from operators import build_operator
+from minibatch import PatternSampler
+
+
+@dataclass
+class ReconConfig:
+    '''Hyper-parameters of the INR reconstruction, defaults match the published runs.'''
+    image_size: int = 128
+    hidden_features: int = 1024 # related to noise level
+    hidden_layers: int = 5
+    first_omega_0: float = 30
+    hidden_omega_0: float = 30.
+    siren_mode: str = 'fused' # 'eager', 'fused' or 'compile', see model.sine_linear
+    precision: str = 'fp32' # network compute: 'fp32', 'bf16' (autocast) or 'fp16' (autocast + loss scaling, cuda)
+    pattern_dtype: str = 'fp32' # storage of A: 'fp32', 'bf16' or 'fp16' (float32 accumulation)
+    operator: str = 'dense' # 'dense', 'stream', 'lowrank' or 'sparse', see operators.py
+    operator_rank: int = None # rank of the 'lowrank' operator
+    operator_density: float = None # fraction of entries kept by the 'sparse' operator
+    operator_chunk: int = 1024 # patterns per block of the 'stream' operator
+    pattern_batch: int = None # patterns sampled per step for the data term, None uses all of them
+    pattern_sampling: str = 'uniform' # 'uniform' or 'importance' (by pattern norm)
+    pattern_batch_growth: float = 2. # the batch grows by this factor every pattern_batch_every steps
+    pattern_batch_every: int = 1000
+    tile_budget: float = None # activation memory per network pass in MiB, None evaluates the whole grid at once
+    lr: float = 5e-6 # important parameter
+    tv_weight: float = 1e-5 # important parameter
+    alpha: float = 8 # may be tuned for better performance, there is a scalling inconsistence (to be explored)
+    total_steps: int = 20000 # upper bound, see early_stopping
+    steps_til_summary: int = 1000
+    num_restarts: int = 1 # restarts are trained in parallel, the best one is kept
+    exit_window: int = 50 # the best iterate of the last exit_window steps is returned, 0 (or None) tracks the whole run
+    ema_decay: float = None # also return a Polyak-averaged reconstruction over the same window
+    early_stopping: bool = True
+    converge_window: int = 500 # steps averaged per convergence check
+    converge_rtol: float = 1e-3 # relative change of the windowed loss considered flat
+    converge_patience: int = 3 # flat windows in a row before stopping
+    min_steps: int = 1000
+    noise_level: object = None # 'poisson' or std of a raw XRF value, enables the residual target
+    discrepancy_tau: float = 1.0
+    device: str = None # None picks cuda when available, else cpu
+    num_threads: int = None # torch intra-op threads on cpu
+    seed: int = None
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def activation_bytes(cfg):
+    '''Estimated autograd memory per coordinate of one SirenEnsemble forward + backward'''
+    # every sine layer keeps its input and pre-activation, backward needs about as much again
+    return 4 * cfg.num_restarts * cfg.hidden_features * (cfg.hidden_layers + 1) * 4
+
+
+def prepare_prior(TXM, image_size):
+    '''Resize a TXM image to the reconstruction grid, returns a (image_size, image_size) tensor'''
+    if isinstance(TXM, torch.Tensor):
+        TXM = TXM.cpu().numpy()
+    TXM = Image.fromarray(np.asarray(TXM))
+    transform = Compose([
+        Resize(image_size),
+        ToTensor(),
+        # Normalize(torch.Tensor([0.5]), torch.Tensor([0.5]))
+    ])
+    TXM = transform(TXM)
+    return torch.transpose(TXM, 1, 2)[0]
+
+
+class Reconstructor:
+    '''
+        Device-resident reconstruction engine.
+
+        The measurement operator A, the coordinate grid and the TXM prior are uploaded once and
+        reused by every call to fit(), so a batch job over many fields of view or elements only
+        pays for training. Patterns or prior can be swapped between calls with set_patterns(),
+        set_operator() or set_prior().
+
+        With tile_budget the network is evaluated over chunks of the coordinate grid that fit the
+        budget: a no-grad pass assembles the output image (n_pixels x n_elements, small next to
+        the activations), the data and TV terms are differentiated w.r.t. that image, and a second
+        pass back-propagates the image gradient through the network one chunk at a time. The
+        parameter gradients are exact, the losses see the whole image so no halo is needed at chunk
+        boundaries, and peak activation memory is bounded by the budget instead of the image area.
+    '''
+
+    def __init__(self, config=None, patterns=None, TXM=None):
+        self.config = config if config is not None else ReconConfig()
+        cfg = self.config
+
+        if cfg.device is None:
+            self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        else:
+            self.device = torch.device(cfg.device)
+        if self.device.type == 'cpu' and cfg.num_threads:
+            torch.set_num_threads(cfg.num_threads)
+        self.policy = PrecisionPolicy(cfg.precision, cfg.pattern_dtype, self.device)
+
+        self.coords = get_mgrid(cfg.image_size, 2).unsqueeze(0).to(self.device)
+        self.op = None
+        self.TXM = None
+        if patterns is not None:
+            self.set_patterns(patterns)
+        if TXM is not None:
+            self.set_prior(TXM)
+
+    def set_patterns(self, patterns):
+        '''patterns: (n_pixels, n_patterns) as stored in the .mat files, wrapped in the configured operator'''
+        cfg = self.config
+        self.set_operator(build_operator(patterns, cfg.operator, self.device, self.policy, rank=cfg.operator_rank,
+                                         density=cfg.operator_density, chunk_rows=cfg.operator_chunk))
+
+    def set_operator(self, op):
+        '''op: any operators.MeasurementOperator'''
+        n_pixels = self.config.image_size ** 2
+        if op.n_pixels != n_pixels:
+            raise ValueError("patterns have %d pixels, expected %d for image_size %d"
+                             % (op.n_pixels, n_pixels, self.config.image_size))
+        self.op = op
+
+    def set_prior(self, TXM, prepared=False):
+        '''
+            TXM: raw TXM image, resized to the reconstruction grid, or with prepared=True an
+                (image_size, image_size) prior already on the grid and in the pixel order of the patterns
+        '''
+        if prepared:
+            self.TXM = torch.as_tensor(np.asarray(TXM), dtype=torch.float32).to(self.device)
+        else:
+            self.TXM = prepare_prior(TXM, self.config.image_size).to(self.device)
+
+    def prepare_measurements(self, xrf):
+        '''xrf: (n_patterns,) or (n_patterns, n_elements), returns the scaled device tensor'''
+        compressed = torch.tensor(np.asarray(xrf), dtype=torch.float32)
+        if compressed.dim() == 1:
+            compressed = compressed.unsqueeze(1)
+        if compressed.shape[0] != self.op.n_patterns:
+            raise ValueError("got %d XRF values for %d patterns" % (compressed.shape[0], self.op.n_patterns))
+        return (compressed * self.config.alpha).to(self.device)
+
+    def build_model(self, n_elements):
+        cfg = self.config
+        return SirenEnsemble(in_features=2, out_features=n_elements, hidden_features=cfg.hidden_features,
+                             hidden_layers=cfg.hidden_layers, outermost_linear=True,
+                             first_omega_0=cfg.first_omega_0, hidden_omega_0=cfg.hidden_omega_0,
+                             num_members=cfg.num_restarts, mode=cfg.siren_mode,
+                             need_input_grad=False).to(self.device)
+
+    def tiles(self):
+        '''Coordinate chunks of the grid that fit tile_budget, None for a single pass'''
+        cfg = self.config
+        n_pixels = cfg.image_size ** 2
+        if not cfg.tile_budget:
+            return None
+        size = max(1, int(cfg.tile_budget * 2 ** 20 // activation_bytes(cfg)))
+        if size >= n_pixels:
+            return None
+        return [slice(i, min(i + size, n_pixels)) for i in range(0, n_pixels, size)]
+
+    def evaluate(self, model, tiles=None):
+        '''Network output on the whole grid without autograd, (num_restarts, n_pixels, n_elements) float32'''
+        with torch.no_grad(), self.policy.autocast():
+            if tiles is None:
+                return model(self.coords)[0].float()
+            return torch.cat([model(self.coords[:, t])[0].float() for t in tiles], 1)
+
+    def data_loss(self, model, compressed):
+        '''Data term of every restart on all patterns, compressed as returned by prepare_measurements()'''
+        with torch.no_grad():
+            return ((self.op.forward(self.evaluate(model, self.tiles())) - compressed) ** 2).mean(1).sum(-1)
+
+    def fit(self, xrf, telemetry=None, model=None, optim_state=None):
+        '''
+            Reconstruct the maps of one field of view.
+
+            Inputs:
+                xrf: XRF amounts, (n_patterns,) or (n_patterns, n_elements)
+                telemetry: optional Telemetry, receives the losses and a recon/TXM snapshot of the
+                    best restart every steps_til_summary steps and the per-phase step timings
+                model: SirenEnsemble to continue training (e.g. from a coarser grid), a new one by default
+                optim_state: Adam state dict to resume from, its learning rate is reset to config.lr
+
+            Outputs:
+                dict with xhat (n_elements, H, W), y_loss and loss of the kept restart, the step
+                xhat was taken at, xhat_ema (with ema_decay), the number of steps run, why training
+                stopped ('max_steps', 'plateau' or 'residual'), the wall time in seconds and the
+                trained model and its optimizer
+        '''
+        if self.op is None or self.TXM is None:
+            raise RuntimeError("set_patterns() and set_prior() must be called before fit()")
+        cfg = self.config
+        if cfg.total_steps < 1:
+            raise ValueError("total_steps must be at least 1, got %d" % cfg.total_steps)
+        if cfg.seed is not None:
+            torch.manual_seed(cfg.seed)
+        exit_window = cfg.exit_window or 0
+
+        compressed = self.prepare_measurements(xrf)
+        n_elements = compressed.shape[1]
+        num_restarts = cfg.num_restarts
+        image_size = cfg.image_size
+
+        img_siren = self.build_model(n_elements) if model is None else model
+        optim = torch.optim.Adam(lr=cfg.lr, params=img_siren.parameters())
+        if optim_state is not None:
+            optim.load_state_dict(optim_state)
+            for group in optim.param_groups:
+                group['lr'] = cfg.lr
+        scaler = self.policy.grad_scaler()
+
+        sampler = None
+        if cfg.pattern_batch:
+            sampler = PatternSampler(self.op.n_patterns, cfg.pattern_batch, cfg.pattern_sampling,
+                                     self.op.row_norms() if cfg.pattern_sampling == 'importance' else None,
+                                     cfg.pattern_batch_growth, cfg.pattern_batch_every, self.device)
+
+        monitor = None
+        if cfg.early_stopping:
+            target = None
+            if cfg.noise_level is not None:
+                target = residual_target(compressed, cfg.noise_level, cfg.alpha, cfg.discrepancy_tau)
+            monitor = ConvergenceMonitor(window=cfg.converge_window, rtol=cfg.converge_rtol,
+                                         patience=cfg.converge_patience, min_steps=cfg.min_steps,
+                                         residual_target=target, point_estimates=sampler is not None)
+
+        tracker = BestIterateTracker(cfg.ema_decay)
+        # once converged, training continues for exit_window steps to pick the best iterate
+        end_step = cfg.total_steps
+        stop_reason = 'max_steps'
+        start = time.time()
+
+        timer = StepTimer(active=False)
+        tiles = self.tiles()
+        rows = None
+
+        for i in range(cfg.total_steps):
+            if telemetry is not None:
+                timer = telemetry.step_timer(i, self.device)
+            timer.start()
+
+            if tiles is None:
+                with self.policy.autocast():
+                    model_output, coords = img_siren(self.coords) # (num_restarts, n_pixels, n_elements)
+                model_output = model_output.float()
+            else:
+                # the losses are differentiated w.r.t. the assembled image, see backward below
+                model_output = self.evaluate(img_siren, tiles).requires_grad_()
+            timer.mark('forward')
+            if sampler is not None and exit_window and i >= end_step - exit_window:
+                # exact losses for the iterates the exit window compares, whatever ends the run
+                sampler.full_batch()
+            rows, weights = sampler.sample(i) if sampler is not None else (None, None)
+            if rows is None:
+                # one batched product serves every restart and element: (n_patterns, n_pixels) @ (n_pixels, n_elements)
+                compressed_out = self.op.forward(model_output)
+                target = compressed
+            else:
+                # unbiased estimate of the full data term from a mini-batch of patterns
+                compressed_out = self.op.forward_rows(model_output, rows)
+                target = compressed.index_select(0, rows)
+            recon = model_output.transpose(1, 2).reshape(num_restarts, n_elements, image_size, image_size)
+
+            # per-element terms are summed so every element gets the gradient scale of a single-element run
+            squared = (compressed_out - target) ** 2
+            if weights is not None:
+                squared = squared * weights[:, None]
+            residual = squared.mean(1) # (num_restarts, n_elements)
+            y_loss = residual.sum(-1)
+            timer.mark('projection')
+            tv_loss = torch.stack([gradient_loss(recon[k], self.TXM) for k in range(num_restarts)])
+            member_loss = y_loss + cfg.tv_weight*n_elements*tv_loss
+            timer.mark('gradient_loss')
+            # members are independent, summing keeps each member's gradient identical to a standalone run
+            loss = member_loss.sum()
+
+            # stop and best-iterate decisions only see exact losses: with a sub-sampled data term,
+            # evaluate it on all patterns where one is made, and track whole runs at those steps only
+            exact_residual, exact_loss = residual, member_loss
+            monitor_due = monitor is not None and end_step == cfg.total_steps and monitor.due
+            if rows is not None:
+                exact_residual = exact_loss = None
+                if monitor_due or i + 1 >= end_step or not (i + 1) % cfg.converge_window:
+                    with torch.no_grad():
+                        exact_residual = ((self.op.forward(model_output.detach()) - compressed) ** 2).mean(1)
+                    exact_loss = exact_residual.sum(-1) + cfg.tv_weight*n_elements*tv_loss.detach()
+
+            if exact_loss is not None and (not exit_window or i >= end_step - exit_window):
+                tracker.update(i, exact_loss, recon)
+            if i + 1 >= end_step:
+                break
+
+            if monitor is not None and end_step == cfg.total_steps:
+                reason = monitor.update(i, loss if exact_loss is None else exact_loss.sum(), exact_residual)
+                if reason is not None:
+                    stop_reason = reason
+                    end_step = min(cfg.total_steps, i + 1 + exit_window)
+
+            if telemetry is not None and not i % cfg.steps_til_summary:
+                # stays on the device, the writer thread reads it back
+                best = torch.argmin(member_loss).view(1)
+                telemetry.log(i, loss=member_loss.min(), y_loss=y_loss.index_select(0, best)[0])
+                best_recon = recon.detach().index_select(0, best)[0]
+                telemetry.snapshot(i, 'recon_TXM', torch.cat([best_recon[k].t() for k in range(n_elements)]
+                                                            + [self.TXM.t()], 1))
+
+            optim.zero_grad()
+            if scaler is not None:
+                loss = scaler.scale(loss)
+            loss.backward()
+            if tiles is not None:
+                # recompute each chunk with autograd and accumulate its share of the parameter gradients
+                grad_output = model_output.grad
+                for t in tiles:
+                    with self.policy.autocast():
+                        chunk_output, _ = img_siren(self.coords[:, t])
+                    chunk_output.float().backward(grad_output[:, t])
+            timer.mark('backward')
+            if scaler is None:
+                optim.step()
+            else:
+                scaler.step(optim)
+                scaler.update()
+            timer.mark('optimizer')
+            if telemetry is not None:
+                telemetry.timing(i, timer)
+
+        if rows is not None:
+            # the last step only estimated the data term, pick the restart on its exact value
+            y_loss = exact_residual.sum(-1)
+
+        # lowest-loss iterate of every restart within the exit window, then the restart with the lowest y_loss
+        tracked = tracker.result()
+        y_loss = y_loss.detach().cpu().numpy()
+        idx_re = np.argmin(y_loss, axis=0)
+
+        return {"xhat": tracked["best"][idx_re],
+                "xhat_ema": None if tracked["ema"] is None else tracked["ema"][idx_re],
+                "y_loss": y_loss[idx_re],
+                "loss": tracked["best_loss"][idx_re],
+                "best_step": tracked["best_step"][idx_re],
+                "steps": i + 1,
+                "stop_reason": stop_reason,
+                "time": time.time() - start,
+                "model": img_siren,
+                "optimizer": optim}
+
+
+def reconstruct(patterns, xrf, TXM, config=None, telemetry=None):
+    '''One-shot helper, use a Reconstructor directly to keep A and the prior resident across calls'''
+    return Reconstructor(config, patterns, TXM).fit(xrf, telemetry=telemetry)
@@ -0,0 +1,175 @@
+# Simulated compressive measurements and reconstruction sweeps
+import argparse
+import csv
+import itertools
+import multiprocessing
+import time
+
+import numpy as np
+import torch
+from pytorch_msssim import ssim
+
+from utils import psnr, rsnr
+from reconstructor import ReconConfig, Reconstructor
+
+
+def measure_batch(y, noise_snr=40, tau=100, generator=None):
+    '''
+        utils.measure() for tensors of any shape on any device: photon noise on y * tau (the
+        sign is kept for negative values) plus Gaussian readout noise of noise_snr electrons,
+        back in units of y. As in measure(), tau=inf only adds the readout noise (unscaled);
+        noise_snr=0 and tau=inf give noise-free measurements.
+    '''
+    readout = torch.randn(y.shape, generator=generator, device=y.device, dtype=y.dtype) * noise_snr
+    if tau == float('inf'):
+        return y + readout
+    photons = torch.poisson((y * tau).abs(), generator=generator) * torch.sign(y)
+    return (photons + readout) / tau
+
+
+def phantoms(batch, image_size, n_ellipses=10, generator=None, device='cpu'):
+    '''
+        Random ellipse phantoms in [0, 1], (batch, image_size, image_size): every ellipse adds
+        its intensity inside, evaluated for the whole batch with one broadcast.
+    '''
+    g = dict(generator=generator, device=device)
+    centre = torch.rand(batch, n_ellipses, 2, **g) * 1.2 - 0.6
+    axes = torch.rand(batch, n_ellipses, 2, **g) * 0.35 + 0.05
+    angle = torch.rand(batch, n_ellipses, **g) * np.pi
+    intensity = torch.rand(batch, n_ellipses, **g) * 2 - 0.5
+
+    lin = torch.linspace(-1, 1, image_size, device=device)
+    y, x = torch.meshgrid(lin, lin, indexing='ij')
+    dx = x - centre[..., 0, None, None]
+    dy = y - centre[..., 1, None, None]
+    cos, sin = torch.cos(angle)[..., None, None], torch.sin(angle)[..., None, None]
+    u = (dx * cos + dy * sin) / axes[..., 0, None, None]
+    v = (-dx * sin + dy * cos) / axes[..., 1, None, None]
+    img = ((u ** 2 + v ** 2 <= 1).float() * intensity[..., None, None]).sum(1)
+    lo = img.amin((1, 2), keepdim=True)
+    hi = img.amax((1, 2), keepdim=True)
+    return (img - lo) / (hi - lo).clamp_min(1e-12)
+
+
+def synthetic_patterns(n_patterns, image_size, kind='uniform', generator=None, device='cpu', correlation=2.):
+    '''
+        (n_patterns, image_size^2) illumination patterns:
+            'uniform': i.i.d. uniform in [0, 1] (as the simulated .mat files)
+            'binary': i.i.d. Bernoulli(0.5)
+            'speckle': smooth random fields (Gaussian low-pass of white noise, correlation length
+                in pixels), normalized to [0, 1], closer to the measured structured illumination
+    '''
+    g = dict(generator=generator, device=device)
+    if kind == 'uniform':
+        return torch.rand(n_patterns, image_size ** 2, **g)
+    if kind == 'binary':
+        return (torch.rand(n_patterns, image_size ** 2, **g) < 0.5).float()
+    if kind != 'speckle':
+        raise ValueError("unknown pattern kind %r" % kind)
+    noise = torch.randn(n_patterns, image_size, image_size, **g)
+    f = torch.fft.fftfreq(image_size, device=device)
+    kernel = torch.exp(-2 * (np.pi * correlation) ** 2 * (f[:, None] ** 2 + f[None, :] ** 2))
+    field = torch.fft.ifft2(torch.fft.fft2(noise) * kernel).real.reshape(n_patterns, -1)
+    lo, hi = field.amin(1, keepdim=True), field.amax(1, keepdim=True)
+    return (field - lo) / (hi - lo).clamp_min(1e-12)
+
+
+def quality(img, xhat):
+    '''PSNR, RSNR and SSIM of a reconstruction against the ground truth'''
+    x, x_hat = np.asarray(img, dtype=np.float32), np.asarray(xhat, dtype=np.float32)
+    s = ssim(torch.from_numpy(x_hat)[None, None], torch.from_numpy(x)[None, None],
+             data_range=float(x.max() - x.min())).item()
+    return psnr(x, x_hat), rsnr(x, x_hat), s
+
+
+def run_case(case):
+    '''
+        One reconstruction of a sweep: a phantom and a pattern set generated from case['seed'],
+        noisy measurements, Reconstructor.fit() with the case's config overrides.
+    '''
+    generator = torch.Generator().manual_seed(case['seed'])
+    size = case['image_size']
+    img = phantoms(1, size, generator=generator)[0]
+    A = synthetic_patterns(int(round(case['sampling'] * size ** 2)), size, case['patterns'], generator)
+    y = measure_batch(A @ img.reshape(-1), case['readout'], case['tau'], generator)
+
+    cfg = ReconConfig(image_size=size, seed=case['seed'], **case['config'])
+    reconstructor = Reconstructor(cfg, A.T.numpy())
+    reconstructor.set_prior(img, prepared=True)
+    result = reconstructor.fit(y.numpy())
+    p, r, s = quality(img.numpy(), result['xhat'][0])
+    return dict({k: v for k, v in case.items() if k != 'config'}, **case['config'],
+                psnr=float(p), rsnr=float(r), ssim=s, steps=result["steps"], time=result["time"])
+
+
+def sweep(image_sizes, samplings, taus, readout=40., repeats=1, patterns='uniform', grid=None, base=None,
+          workers=1, threads=1):
+    '''
+        Reconstructions over image size x sampling ratio x photon budget (tau) x repeats x every
+        combination of the ReconConfig overrides in grid (e.g. {'alpha': [1, 8], 'tv_weight':
+        [1e-5, 1e-4]}), run by `workers` processes with `threads` torch threads each.
+
+        Outputs:
+            one dict per reconstruction with the case, psnr, rsnr, ssim, steps and time
+    '''
+    grid = grid or {}
+    base = base or {}
+    keys = list(grid)
+    cases = []
+    for size, sampling, tau, repeat, values in itertools.product(image_sizes, samplings, taus, range(repeats),
+                                                                 itertools.product(*grid.values())):
+        cases.append({"image_size": size, "sampling": sampling, "tau": tau, "readout": readout,
+                      "patterns": patterns, "seed": repeat,
+                      "config": dict(base, num_threads=threads, **dict(zip(keys, values)))})
+    if workers <= 1:
+        return [run_case(case) for case in cases]
+    # spawn: forked workers would share the parent's OpenMP state
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        return pool.map(run_case, cases, chunksize=1)
+
+
+def print_table(rows, columns):
+    print(" ".join("%11s" % c for c in columns))
+    for row in rows:
+        print(" ".join(("%11.4g" if isinstance(row[c], float) else "%11s") % row[c] for c in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated reconstruction sweeps')
+    parser.add_argument('--image-sizes', type=int, nargs='+', default=[32, 64])
+    parser.add_argument('--samplings', type=float, nargs='+', default=[0.1, 0.3])
+    parser.add_argument('--taus', type=float, nargs='+', default=[float('inf'), 100.],
+                        help='photon integration times of utils.measure, inf disables photon noise (not the readout)')
+    parser.add_argument('--readout', type=float, default=40., help='readout noise in electrons')
+    parser.add_argument('--patterns', default='uniform', choices=['uniform', 'binary', 'speckle'])
+    parser.add_argument('--repeats', type=int, default=1, help='phantoms and pattern sets per case')
+    parser.add_argument('--alpha', type=float, nargs='+', default=[1.])
+    parser.add_argument('--tv-weight', type=float, nargs='+', default=[1e-5])
+    parser.add_argument('--lr', type=float, default=1e-4)
+    parser.add_argument('--hidden-features', type=int, default=256)
+    parser.add_argument('--hidden-layers', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=2000)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per worker')
+    parser.add_argument('--csv', default=None, help='also write the table to this file')
+    args = parser.parse_args()
+
+    base = {"lr": args.lr, "hidden_features": args.hidden_features, "hidden_layers": args.hidden_layers,
+            "total_steps": args.steps, "exit_window": max(args.steps // 10, 1), "device": args.device}
+    grid = {"alpha": args.alpha, "tv_weight": args.tv_weight}
+    start = time.time()
+    rows = sweep(args.image_sizes, args.samplings, args.taus, args.readout, args.repeats, args.patterns,
+                 grid, base, args.workers, args.threads)
+    columns = ["image_size", "sampling", "tau", "alpha", "tv_weight", "seed", "psnr", "rsnr", "ssim", "steps", "time"]
+    print_table(rows, columns)
+    print("%d reconstructions in %.1f s" % (len(rows), time.time() - start))
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+# Classical solvers of the compressive measurement y = A x
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy.sparse.linalg import LinearOperator, lsqr
+
+from utils import cal_gradient
+
+
+def gradient_adjoint(dx, dy):
+    '''Adjoint of utils.cal_gradient (forward differences, zero last column/row), (..., h, w)'''
+    dx, dy = dx[..., :-1], dy[..., :-1, :]
+    return F.pad(dx, [1, 0]) - F.pad(dx, [0, 1]) + F.pad(dy, [0, 0, 1, 0]) - F.pad(dy, [0, 0, 0, 1])
+
+
+def dense_adjoint(op):
+    '''A^T of any MeasurementOperator as a (n_pixels, n_patterns) float64 tensor'''
+    eye = torch.eye(op.n_patterns, dtype=torch.float32, device=_op_device(op))
+    return op.adjoint(eye).double()
+
+
+def _op_device(op):
+    for name in ('A', 'U', 'patterns'):
+        value = getattr(op, name, None)
+        if isinstance(value, torch.Tensor):
+            return value.device
+    return torch.device('cpu')
+
+
+def spectral_norm2(op, iterations=50, seed=0):
+    '''||A||_2^2 by power iteration on A^T A'''
+    generator = torch.Generator().manual_seed(seed)
+    v = torch.randn(op.n_pixels, 1, generator=generator).to(_op_device(op))
+    norm = 0.
+    for _ in range(iterations):
+        v = op.adjoint(op.forward(v))
+        norm = torch.linalg.vector_norm(v).item()
+        v = v / norm
+    return norm
+
+
+class LinearSolver:
+    '''
+        Common interface of the classical solvers.
+
+        The objective matches the per-element loss of Reconstructor.fit():
+            mean_p (A x - y)_p^2 + regularization
+        so lam and tv_weight mean the same for every solver. The ridge solvers (tikhonov, cg,
+        lsqr) solve the equivalent summed problem ||A x - y||^2 + lam * n_patterns ||x||^2.
+        solve() takes the measurements as prepared by Reconstructor.prepare_measurements(),
+        (n_patterns,) or (n_patterns, n_elements), and the (image_size, image_size) TXM prior
+        in the reconstruction layout, and returns a dict with xhat (n_elements, H, W), y_loss
+        (data term summed over elements), the iterations run and the wall time, so it can be
+        compared with, or used to initialize (see initial_model), the INR reconstruction.
+
+        Inputs:
+            op: operators.MeasurementOperator
+            image_size: side of the reconstruction grid
+    '''
+    name = None
+
+    def __init__(self, op, image_size):
+        if op.n_pixels != image_size ** 2:
+            raise ValueError("operator has %d pixels, expected %d" % (op.n_pixels, image_size ** 2))
+        self.op = op
+        self.image_size = image_size
+        self.device = _op_device(op)
+        self.iterations = 0
+
+    @property
+    def ridge(self):
+        '''lam of mean_p (A x - y)_p^2 + lam ||x||^2 as the weight of ||A x - y||^2 + ridge ||x||^2'''
+        return self.lam * self.op.n_patterns
+
+    def _solve(self, y, TXM):
+        '''y: (n_patterns, n_elements) float32, returns x (n_pixels, n_elements)'''
+        raise NotImplementedError
+
+    def solve(self, compressed, TXM=None):
+        start = time.time()
+        y = torch.as_tensor(np.asarray(compressed.cpu() if isinstance(compressed, torch.Tensor) else compressed),
+                            dtype=torch.float32).to(self.device)
+        if y.dim() == 1:
+            y = y.unsqueeze(1)
+        if TXM is not None:
+            TXM = torch.as_tensor(np.asarray(TXM.cpu() if isinstance(TXM, torch.Tensor) else TXM),
+                                  dtype=torch.float32).to(self.device)
+        with torch.no_grad():
+            x = self._solve(y, TXM).float()
+            y_loss = ((self.op.forward(x) - y) ** 2).mean(0).sum().item()
+        n = self.image_size
+        return {"xhat": x.t().reshape(-1, n, n).cpu().numpy(), "y_loss": y_loss,
+                "iterations": self.iterations, "time": time.time() - start}
+
+
+class Tikhonov(LinearSolver):
+    '''
+        min mean_p (A x - y)_p^2 + lam ||x||^2, solved as x = A^T (A A^T + ridge I)^-1 y.
+
+        The n_patterns x n_patterns Gram matrix is factorized once per solver and reused by every
+        solve: method='svd' keeps its eigendecomposition, which serves any lam (lam=0 is the
+        pseudo-inverse of A, as pinv(H2') in calInvertibility.m, with eigenvalues below
+        rcond * max cut off); method='cholesky' keeps one factor per lam.
+    '''
+    name = 'tikhonov'
+
+    def __init__(self, op, image_size, lam=0., method='svd', rcond=1e-10):
+        super().__init__(op, image_size)
+        if method not in ('svd', 'cholesky'):
+            raise ValueError("unknown method %r" % method)
+        self.lam = lam
+        self.method = method
+        self.rcond = rcond
+        self.At = dense_adjoint(op)
+        self.gram = self.At.t() @ self.At
+        self._eigh = None
+        self._cholesky = {}
+
+    def _solve(self, y, TXM):
+        y = y.double()
+        if self.method == 'svd':
+            if self._eigh is None:
+                self._eigh = torch.linalg.eigh(self.gram)
+            s, U = self._eigh
+            inv = 1. / (s + self.ridge)
+            inv[s + self.ridge <= self.rcond * s.max()] = 0.
+            w = U @ (inv[:, None] * (U.t() @ y))
+        else:
+            if self.lam not in self._cholesky:
+                eye = torch.eye(self.gram.shape[0], dtype=self.gram.dtype, device=self.gram.device)
+                self._cholesky[self.lam] = torch.linalg.cholesky(self.gram + self.ridge * eye)
+            w = torch.cholesky_solve(y, self._cholesky[self.lam])
+        self.iterations = 1
+        return self.At @ w
+
+
+class ConjugateGradient(LinearSolver):
+    '''
+        Conjugate gradient on the normal equations (A^T A + ridge I) x = A^T y, matrix-free through
+        the operator (also the streamed one), all elements at once.
+    '''
+    name = 'cg'
+
+    def __init__(self, op, image_size, lam=0., iterations=100, tol=1e-6):
+        super().__init__(op, image_size)
+        self.lam = lam
+        self.max_iterations = iterations
+        self.tol = tol
+
+    def _solve(self, y, TXM):
+        apply = lambda x: self.op.adjoint(self.op.forward(x)) + self.ridge * x
+        x, self.iterations = conjugate_gradient(apply, self.op.adjoint(y), None, self.max_iterations, self.tol)
+        return x
+
+
+def conjugate_gradient(apply, b, x=None, iterations=100, tol=1e-6):
+    '''CG for a symmetric positive (semi-)definite apply(), independently per column of b (n, k)'''
+    x = torch.zeros_like(b) if x is None else x.clone()
+    r = b - apply(x)
+    p = r.clone()
+    rr = (r * r).sum(0)
+    threshold = (tol * torch.linalg.vector_norm(b, dim=0)) ** 2
+    for i in range(iterations):
+        if bool((rr <= threshold).all()):
+            return x, i
+        Ap = apply(p)
+        step = rr / (p * Ap).sum(0).clamp_min(1e-30)
+        x += step * p
+        r -= step * Ap
+        rr_new = (r * r).sum(0)
+        p = r + (rr_new / rr.clamp_min(1e-30)) * p
+        rr = rr_new
+    return x, iterations
+
+
+class LSQR(LinearSolver):
+    '''scipy.sparse.linalg.lsqr with damping sqrt(ridge), one element at a time through the operator'''
+    name = 'lsqr'
+
+    def __init__(self, op, image_size, lam=0., iterations=100, tol=1e-6):
+        super().__init__(op, image_size)
+        self.lam = lam
+        self.max_iterations = iterations
+        self.tol = tol
+
+    def _solve(self, y, TXM):
+        def matvec(v):
+            v = torch.as_tensor(np.asarray(v, dtype=np.float32).reshape(-1, 1), device=self.device)
+            return self.op.forward(v)[:, 0].double().cpu().numpy()
+
+        def rmatvec(v):
+            v = torch.as_tensor(np.asarray(v, dtype=np.float32).reshape(-1, 1), device=self.device)
+            return self.op.adjoint(v)[:, 0].double().cpu().numpy()
+
+        A = LinearOperator((self.op.n_patterns, self.op.n_pixels), matvec=matvec, rmatvec=rmatvec, dtype=np.float64)
+        columns, self.iterations = [], 0
+        for b in y.t().double().cpu().numpy():
+            result = lsqr(A, b, damp=np.sqrt(self.ridge), atol=self.tol, btol=self.tol, iter_lim=self.max_iterations)
+            columns.append(result[0])
+            self.iterations = max(self.iterations, result[2])
+        return torch.as_tensor(np.stack(columns, 1), dtype=torch.float32, device=self.device)
+
+
+class _TVSolver(LinearSolver):
+    '''
+        Data term plus the prior of utils.gradient_loss:
+            mean_p (A x - y)_p^2 + tv_weight * (mean |dx(x) - dx(TXM)| + mean |dy(x) - dy(TXM)|)
+        with the TXM gradients from utils.cal_gradient (a plain anisotropic TV without a TXM).
+    '''
+
+    def __init__(self, op, image_size, tv_weight=1e-5, iterations=200):
+        super().__init__(op, image_size)
+        self.tv_weight = tv_weight
+        self.max_iterations = iterations
+        self._lipschitz = None
+
+    @property
+    def lipschitz(self):
+        '''Lipschitz constant of the gradient of the data term, 2 ||A||^2 / n_patterns'''
+        if self._lipschitz is None:
+            self._lipschitz = 2. * spectral_norm2(self.op) / self.op.n_patterns
+        return self._lipschitz
+
+    def images(self, x):
+        return x.t().reshape(-1, self.image_size, self.image_size)
+
+    def pixels(self, img):
+        return img.reshape(img.shape[0], -1).t()
+
+    def data_gradient(self, x, y):
+        return (2. / self.op.n_patterns) * self.op.adjoint(self.op.forward(x) - y)
+
+    def prior(self, TXM, n_elements):
+        if TXM is None:
+            return torch.zeros(n_elements, self.image_size, self.image_size, device=self.device)
+        return TXM.expand(n_elements, -1, -1)
+
+
+def tv_prox(b, lam, iterations=20):
+    '''
+        argmin_x 1/2 ||x - b||^2 + lam * (sum |dx(x)| + sum |dy(x)|), (..., h, w)
+
+        Fast gradient projection on the dual (Beck and Teboulle, 2009).
+    '''
+    if lam <= 0:
+        return b
+    px, py = torch.zeros_like(b), torch.zeros_like(b)
+    rx, ry = px, py
+    t = 1.
+    for _ in range(iterations):
+        dx, dy = cal_gradient(b - lam * gradient_adjoint(rx, ry))
+        qx = (rx + dx / (8. * lam)).clamp(-1., 1.)
+        qy = (ry + dy / (8. * lam)).clamp(-1., 1.)
+        t_next = (1. + np.sqrt(1. + 4. * t * t)) / 2.
+        rx = qx + ((t - 1.) / t_next) * (qx - px)
+        ry = qy + ((t - 1.) / t_next) * (qy - py)
+        px, py, t = qx, qy, t_next
+    return b - lam * gradient_adjoint(px, py)
+
+
+class FISTA(_TVSolver):
+    '''FISTA with the TV-style prior applied through its proximal operator (tv_prox)'''
+    name = 'fista'
+
+    def __init__(self, op, image_size, tv_weight=1e-5, iterations=200, inner=20):
+        super().__init__(op, image_size, tv_weight, iterations)
+        self.inner = inner
+
+    def _solve(self, y, TXM):
+        L = self.lipschitz
+        # the prior averages over the pixels of each image
+        lam = self.tv_weight / self.image_size ** 2 / L
+        T = self.prior(TXM, y.shape[1])
+        x = torch.zeros(self.op.n_pixels, y.shape[1], device=self.device)
+        z, t = x, 1.
+        for _ in range(self.max_iterations):
+            v = self.images(z - self.data_gradient(z, y) / L)
+            x_next = self.pixels(T + tv_prox(v - T, lam, self.inner))
+            t_next = (1. + np.sqrt(1. + 4. * t * t)) / 2.
+            z = x_next + ((t - 1.) / t_next) * (x_next - x)
+            x, t = x_next, t_next
+        self.iterations = self.max_iterations
+        return x
+
+
+class ADMM(_TVSolver):
+    '''
+        ADMM on the split z = grad(x) - grad(TXM): a few warm-started CG steps for the x update,
+        soft thresholding for z. rho defaults to the Lipschitz constant of the data term over 8
+        (the norm of the gradient operator squared).
+    '''
+    name = 'admm'
+
+    def __init__(self, op, image_size, tv_weight=1e-5, iterations=100, rho=None, cg_iterations=10):
+        super().__init__(op, image_size, tv_weight, iterations)
+        self.rho = rho
+        self.cg_iterations = cg_iterations
+
+    def _solve(self, y, TXM):
+        rho = self.rho if self.rho is not None else self.lipschitz / 8.
+        kappa = self.tv_weight / self.image_size ** 2 / rho
+        scale = 2. / self.op.n_patterns
+        gx, gy = cal_gradient(self.prior(TXM, y.shape[1]))
+
+        def apply(x):
+            img = self.images(x)
+            return scale * self.op.adjoint(self.op.forward(x)) + rho * self.pixels(gradient_adjoint(*cal_gradient(img)))
+
+        Aty = scale * self.op.adjoint(y)
+        x = torch.zeros(self.op.n_pixels, y.shape[1], device=self.device)
+        zx, zy = torch.zeros_like(gx), torch.zeros_like(gy)
+        ux, uy = torch.zeros_like(gx), torch.zeros_like(gy)
+        for _ in range(self.max_iterations):
+            b = Aty + rho * self.pixels(gradient_adjoint(gx + zx - ux, gy + zy - uy))
+            x, _ = conjugate_gradient(apply, b, x, self.cg_iterations, 0.)
+            dx, dy = cal_gradient(self.images(x))
+            vx, vy = dx - gx + ux, dy - gy + uy
+            zx = torch.sign(vx) * (vx.abs() - kappa).clamp_min(0.)
+            zy = torch.sign(vy) * (vy.abs() - kappa).clamp_min(0.)
+            ux, uy = vx - zx, vy - zy
+        self.iterations = self.max_iterations
+        return x
+
+
+SOLVERS = {cls.name: cls for cls in (Tikhonov, ConjugateGradient, LSQR, FISTA, ADMM)}
+
+
+def build_solver(name, op, image_size, **kwargs):
+    '''One of SOLVERS by name, kwargs go to its constructor'''
+    if name not in SOLVERS:
+        raise ValueError("unknown solver %r, expected one of %s" % (name, ', '.join(SOLVERS)))
+    return SOLVERS[name](op, image_size, **kwargs)
+
+
+def initial_model(reconstructor, xhat, steps=500, lr=1e-4):
+    '''
+        SirenEnsemble of the reconstructor regressed onto a solver's xhat (n_elements, H, W),
+        to start Reconstructor.fit(model=...) from the classical solution
+    '''
+    target = torch.as_tensor(np.asarray(xhat), dtype=torch.float32, device=reconstructor.device)
+    target = target.reshape(target.shape[0], -1).t() # (n_pixels, n_elements)
+    model = reconstructor.build_model(target.shape[1])
+    optim = torch.optim.Adam(lr=lr, params=model.parameters())
+    for _ in range(steps):
+        with reconstructor.policy.autocast():
+            output, _ = model(reconstructor.coords)
+        loss = ((output.float() - target) ** 2).mean()
+        optim.zero_grad()
+        loss.backward()
+        optim.step()
+    return model
@@ -0,0 +1,186 @@
+# Element amounts from the XRF spectra of a scan, all spectra at once
+import argparse
+import glob
+import os
+
+import numpy as np
+import scipy.linalg as sl
+from scipy.io import loadmat, savemat
+from scipy.optimize import nnls
+
+# K-alpha / K-beta line energies in keV
+K_LINES = {
+    'Ti': (4.511, 4.932), 'V': (4.952, 5.427), 'Cr': (5.415, 5.947), 'Mn': (5.899, 6.490),
+    'Fe': (6.404, 7.058), 'Co': (6.930, 7.649), 'Ni': (7.478, 8.265), 'Cu': (8.048, 8.905),
+    'Zn': (8.639, 9.572),
+}
+K_BETA_RATIO = 0.13
+
+
+def load_spectra(paths, key='data'):
+    '''
+        Spectra saved by collectXRF (one .mat per pattern with a `data` vector).
+
+        Inputs:
+            paths: directory (all .mat files, in name order) or list of files
+        Outputs:
+            (n_spectra, n_channels) float64, the file names
+    '''
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(os.path.join(paths, '*.mat')))
+    spectra = np.stack([loadmat(p)[key].reshape(-1) for p in paths]).astype(np.float64)
+    return spectra, paths
+
+
+def peak_width(energy, noise_fwhm=0.12, fano=0.114, epsilon=3.85e-3):
+    '''Gaussian sigma in keV of a silicon drift detector line at energy (keV)'''
+    fwhm = np.sqrt(noise_fwhm ** 2 + 2.355 ** 2 * fano * epsilon * energy)
+    return fwhm / 2.355
+
+
+def channel_energies(n_channels, gain=0.01, offset=0.):
+    '''keV of every channel, E = offset + gain * channel'''
+    return offset + gain * np.arange(n_channels)
+
+
+def gaussian_basis(energies, elements, noise_fwhm=0.12, background=2):
+    '''
+        Columns: per element a unit-area K-alpha line plus K_BETA_RATIO of a unit-area K-beta
+        line (so the coefficient is the K-alpha area in counts), then a polynomial background of
+        the given degree. (n_channels, n_elements + background + 1)
+    '''
+    gain = energies[1] - energies[0]
+    columns = []
+    for element in elements:
+        column = np.zeros_like(energies)
+        for line, weight in zip(K_LINES[element], (1., K_BETA_RATIO)):
+            sigma = peak_width(line, noise_fwhm)
+            column += weight * gain / (sigma * np.sqrt(2 * np.pi)) * np.exp(-0.5 * ((energies - line) / sigma) ** 2)
+        columns.append(column)
+    scaled = (energies - energies.mean()) / max(np.ptp(energies), 1e-12)
+    columns += [scaled ** d for d in range(background + 1)]
+    return np.stack(columns, 1)
+
+
+def roi_weights(energies, elements, noise_fwhm=0.12, width=2., side=1.):
+    '''
+        Linear ROI integration as one (n_channels, n_elements) matrix: counts within
+        +-width sigma of K-alpha, minus the background estimated from side bands of side * width
+        sigma on both sides, scaled to the ROI length.
+    '''
+    W = np.zeros((len(energies), len(elements)))
+    for k, element in enumerate(elements):
+        line = K_LINES[element][0]
+        sigma = peak_width(line, noise_fwhm)
+        d = np.abs(energies - line)
+        roi = d <= width * sigma
+        band = (d > width * sigma) & (d <= (1 + side) * width * sigma)
+        W[roi, k] = 1.
+        if band.any():
+            W[band, k] = -roi.sum() / band.sum()
+    return W
+
+
+class SpectrumFitter:
+    '''
+        Element amounts of many spectra with one shared factorization.
+
+            method='roi': ROI integration with linear background, a single matrix product
+            method='gaussian': linear least squares on gaussian_basis (fixed line positions and
+                widths), solved for all spectra with one QR of the basis
+            method='nnls': non-negative least squares on the basis, or on a reference library
+                (one measured spectrum per element); the basis is reduced to its R factor once,
+                so every spectrum is a (n_basis x n_basis) NNLS problem
+
+        Inputs:
+            elements: element names, keys of K_LINES unless a library is given
+            n_channels: spectrum length
+            gain, offset: channel energy calibration in keV
+            library: optional (n_channels, n_elements) reference spectra for method='nnls'
+            background: degree of the polynomial background of the fitted methods
+    '''
+
+    def __init__(self, elements, n_channels, method='gaussian', gain=0.01, offset=0., noise_fwhm=0.12,
+                 library=None, background=2):
+        if method not in ('roi', 'gaussian', 'nnls'):
+            raise ValueError("unknown method %r" % method)
+        self.elements = list(elements)
+        self.method = method
+        self.energies = channel_energies(n_channels, gain, offset)
+        if method == 'roi':
+            self.W = roi_weights(self.energies, self.elements, noise_fwhm)
+            return
+        if library is not None:
+            poly = gaussian_basis(self.energies, [], noise_fwhm, background)
+            self.basis = np.concatenate([np.asarray(library, dtype=np.float64), poly], 1)
+        else:
+            self.basis = gaussian_basis(self.energies, self.elements, noise_fwhm, background)
+        self.Q, self.R = sl.qr(self.basis, mode='economic')
+        if method == 'nnls':
+            # the background enters through its free least squares fit: project it out once
+            n = len(self.elements)
+            self.Qb, _ = sl.qr(self.R[:, n:], mode='economic')
+            self.R_elements = self._project(self.R[:, :n])
+
+    def fit(self, spectra):
+        '''spectra: (n_spectra, n_channels), returns (n_spectra, n_elements) amounts'''
+        spectra = np.atleast_2d(np.asarray(spectra, dtype=np.float64))
+        if self.method == 'roi':
+            return spectra @ self.W
+        projected = spectra @ self.Q # (n_spectra, n_basis)
+        if self.method == 'gaussian':
+            coeffs = sl.solve_triangular(self.R, projected.T).T
+        else:
+            # only the element amounts are constrained, the background polynomial may go negative
+            coeffs = np.stack([nnls(self.R_elements, b)[0] for b in self._project(projected.T).T])
+        return coeffs[:, :len(self.elements)]
+
+    def _project(self, M):
+        return M - self.Qb @ (self.Qb.T @ M)
+
+    def amounts(self, spectra):
+        '''{'XRF_amount_<element>': (n_spectra,)} as read by utils.load_real_data'''
+        fitted = self.fit(spectra)
+        return {'XRF_amount_' + e: fitted[:, k] for k, e in enumerate(self.elements)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='XRF_amount_<element> vectors from the spectra of a scan')
+    parser.add_argument('spectra', help='directory of the per-pattern spectrum .mat files')
+    parser.add_argument('--elements', nargs='+', default=['Ni', 'Co', 'Mn'])
+    parser.add_argument('--method', default='gaussian', choices=['roi', 'gaussian', 'nnls'])
+    parser.add_argument('--gain', type=float, default=0.01, help='keV per channel')
+    parser.add_argument('--offset', type=float, default=0., help='keV of channel 0')
+    parser.add_argument('--noise-fwhm', type=float, default=0.12, help='electronic noise FWHM [keV]')
+    parser.add_argument('--library', default=None, help='.mat with one reference spectrum per element name')
+    parser.add_argument('--out', default=None, help='.mat for the amounts, default <spectra>_amounts.mat')
+    parser.add_argument('--dataset', default=None,
+                        help='add the amounts to a copy of this dataset .mat instead, written to --out or '
+                             '<dataset>_amounts.mat')
+    parser.add_argument('--in-place', action='store_true', help='overwrite --dataset instead of writing a copy')
+    args = parser.parse_args()
+
+    spectra, paths = load_spectra(args.spectra)
+    library = None
+    if args.library:
+        mat = loadmat(args.library)
+        library = np.stack([mat[e].reshape(-1) for e in args.elements], 1)
+    fitter = SpectrumFitter(args.elements, spectra.shape[1], args.method, args.gain, args.offset,
+                            args.noise_fwhm, library)
+    amounts = fitter.amounts(spectra)
+    if args.dataset:
+        mat = {k: v for k, v in loadmat(args.dataset).items() if not k.startswith('__')}
+        mat.update({k: v[:, None] for k, v in amounts.items()})
+        if args.in_place:
+            out = args.dataset
+        else:
+            out = args.out or os.path.splitext(args.dataset)[0] + '_amounts.mat'
+        savemat(out, mat)
+    else:
+        out = args.out or args.spectra.rstrip('/') + '_amounts.mat'
+        savemat(out, dict({k: v[:, None] for k, v in amounts.items()}, files=np.array(paths, dtype=object)))
+    print("%d spectra, %s: %s -> %s" % (len(paths), args.method, ", ".join(amounts), out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+# Reconstruction that updates while the patterns are still being acquired
+import argparse
+import glob
+import os
+import time
+from dataclasses import replace
+
+import numpy as np
+from scipy.io import loadmat, savemat
+
+from utils import load_real_data
+from reconstructor import ReconConfig, Reconstructor
+from operators import AppendableOperator
+from telemetry import Telemetry, PrintSink, JsonlSink, SnapshotSink
+
+DONE_MARKER = 'DONE'
+
+
+class AcquisitionWatcher:
+    '''
+        New .mat files of an acquisition directory, each returned once, in name order.
+
+        Writers should create <name>.mat atomically (write a temporary name, then rename), a file
+        named DONE marks the end of the scan.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.seen = set()
+
+    def poll(self):
+        paths = sorted(p for p in glob.glob(os.path.join(self.directory, '*.mat')) if p not in self.seen)
+        self.seen.update(paths)
+        return paths
+
+    @property
+    def done(self):
+        return os.path.exists(os.path.join(self.directory, DONE_MARKER))
+
+
+def read_drop(path, elements):
+    '''
+        One acquisition file: pattern (n_pixels,) and XRF_amount_<element> scalars, as in the
+        datasets, and/or the TXM image of the field of view.
+
+        Outputs:
+            pattern (n_pixels,) or None, xrf (n_elements,) or None, TXM or None
+    '''
+    mat = loadmat(path)
+    pattern = mat['pattern'].reshape(-1) if 'pattern' in mat else None
+    xrf = np.array([mat['XRF_amount_' + e].item() for e in elements]) if pattern is not None else None
+    return pattern, xrf, mat.get('TXM')
+
+
+class StreamingReconstruction:
+    '''
+        Keeps training one Siren while patterns arrive.
+
+        New patterns are appended to an AppendableOperator; every update() continues the same
+        network and Adam state for steps_per_update steps on all patterns received so far and
+        publishes the maps through the telemetry (snapshots xhat_<element>, metrics n_patterns,
+        y_loss and change, the relative change of the maps since the previous update). The maps
+        count as stable after stable_patience updates in a row with change below stable_rtol.
+
+        Inputs:
+            config: ReconConfig, total_steps is ignored
+            elements: element names, the order of the XRF columns
+            TXM: raw TXM image, or set later with set_prior()
+            steps_per_update: training steps per update
+            min_patterns: no training before this many patterns
+            telemetry: optional Telemetry receiving the published maps
+    '''
+
+    def __init__(self, config, elements, TXM=None, steps_per_update=200, min_patterns=16,
+                 stable_rtol=1e-2, stable_patience=3, telemetry=None):
+        self.config = replace(config, total_steps=steps_per_update, early_stopping=False, pattern_batch=None)
+        self.elements = list(elements)
+        self.reconstructor = Reconstructor(self.config)
+        self.op = AppendableOperator(self.config.image_size ** 2, self.reconstructor.device,
+                                     self.reconstructor.policy)
+        self.reconstructor.set_operator(self.op)
+        self.xrf = np.zeros((0, len(self.elements)), dtype=np.float32)
+        self.min_patterns = min_patterns
+        self.stable_rtol = stable_rtol
+        self.stable_patience = stable_patience
+        self.telemetry = telemetry
+
+        self.model = None
+        self.optim_state = None
+        self.xhat = None
+        self.steps = 0
+        self.flat_updates = 0
+        if TXM is not None:
+            self.set_prior(TXM)
+
+    def set_prior(self, TXM):
+        self.reconstructor.set_prior(TXM)
+
+    def add(self, patterns, xrf):
+        '''patterns: (k, n_pixels) or (n_pixels,), xrf: (k, n_elements) or (n_elements,)'''
+        self.op.append(patterns)
+        self.xrf = np.concatenate([self.xrf, np.asarray(xrf, dtype=np.float32).reshape(-1, len(self.elements))])
+
+    @property
+    def n_patterns(self):
+        return self.op.n_patterns
+
+    @property
+    def stable(self):
+        return self.flat_updates >= self.stable_patience
+
+    def update(self):
+        '''Train on the patterns received so far, returns the published metrics or None if not ready'''
+        if self.n_patterns < self.min_patterns or self.reconstructor.TXM is None:
+            return None
+        result = self.reconstructor.fit(self.xrf, model=self.model, optim_state=self.optim_state)
+        self.model, self.optim_state = result["model"], result["optimizer"].state_dict()
+        self.steps += result["steps"]
+
+        xhat = result["xhat"]
+        change = np.inf if self.xhat is None else (np.linalg.norm(xhat - self.xhat)
+                                                   / max(np.linalg.norm(xhat), 1e-12))
+        self.flat_updates = self.flat_updates + 1 if change < self.stable_rtol else 0
+        self.xhat = xhat
+
+        metrics = {"n_patterns": self.n_patterns, "y_loss": float(result["y_loss"]), "change": float(change),
+                   "stable": self.stable}
+        if self.telemetry is not None:
+            self.telemetry.log(self.steps, **metrics)
+            for k, element in enumerate(self.elements):
+                self.telemetry.snapshot(self.steps, 'xhat_' + element, xhat[k].T)
+        return metrics
+
+
+def watch(directory, stream, poll_interval=1., idle_timeout=None, stop_when_stable=False):
+    '''
+        Feed the files of an acquisition directory to a StreamingReconstruction until the DONE
+        marker appears (or idle_timeout seconds pass without a new file, or, with
+        stop_when_stable, the maps are stable), training between the polls.
+    '''
+    watcher = AcquisitionWatcher(directory)
+    last_arrival = time.time()
+    while True:
+        # read the marker first, files written before it are then all in this poll
+        done = watcher.done
+        paths = watcher.poll()
+        for path in paths:
+            pattern, xrf, TXM = read_drop(path, stream.elements)
+            if TXM is not None:
+                stream.set_prior(TXM)
+            if pattern is not None:
+                stream.add(pattern, xrf)
+        if paths:
+            last_arrival = time.time()
+
+        metrics = stream.update()
+        if metrics is None:
+            time.sleep(poll_interval)
+        if stop_when_stable and stream.stable:
+            return 'stable'
+        if done and not paths:
+            return 'done'
+        if idle_timeout is not None and time.time() - last_arrival > idle_timeout:
+            return 'idle'
+
+
+def simulate(filename, directory, elements, interval=1., limit=None):
+    '''
+        Replay a dataset as an acquisition: the TXM first, then one pattern file per interval
+        seconds, each written atomically, then the DONE marker.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    Patterns, xrf, TXM = load_real_data(filename, elements)
+    n = Patterns.shape[1] if limit is None else min(limit, Patterns.shape[1])
+
+    def drop(name, variables):
+        tmp = os.path.join(directory, name + '.tmp')
+        savemat(tmp, variables, appendmat=False)
+        os.replace(tmp, os.path.join(directory, name + '.mat'))
+
+    drop('TXM', {"TXM": np.asarray(TXM)})
+    for i in range(n):
+        variables = {"pattern": np.asarray(Patterns[:, i], dtype=np.float32)}
+        for k, element in enumerate(elements):
+            variables['XRF_amount_' + element] = float(xrf[i, k])
+        drop('pattern_%06d' % i, variables)
+        time.sleep(interval)
+    open(os.path.join(directory, DONE_MARKER), 'w').close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconstruction during acquisition')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('watch', help='reconstruct from an acquisition directory as files arrive')
+    p.add_argument('directory')
+    p.add_argument('--elements', nargs='+', default=['Ni'])
+    p.add_argument('--publish', default=None, help='directory of the intermediate maps, default <directory>/maps')
+    p.add_argument('--simulate', default=None, help='replay this dataset into the directory while watching')
+    p.add_argument('--interval', type=float, default=0.5, help='seconds between two simulated patterns')
+    p.add_argument('--steps-per-update', type=int, default=200)
+    p.add_argument('--min-patterns', type=int, default=16)
+    p.add_argument('--stable-rtol', type=float, default=1e-2)
+    p.add_argument('--stop-when-stable', action='store_true')
+    p.add_argument('--idle-timeout', type=float, default=None)
+    p.add_argument('--image-size', type=int, default=ReconConfig.image_size)
+    p.add_argument('--hidden-features', type=int, default=ReconConfig.hidden_features)
+    p.add_argument('--hidden-layers', type=int, default=ReconConfig.hidden_layers)
+    p.add_argument('--lr', type=float, default=ReconConfig.lr)
+    p.add_argument('--tv-weight', type=float, default=ReconConfig.tv_weight)
+    p.add_argument('--device', default=None)
+
+    p = sub.add_parser('simulate', help='replay a dataset as one file per pattern')
+    p.add_argument('filename')
+    p.add_argument('directory')
+    p.add_argument('--elements', nargs='+', default=['Ni'])
+    p.add_argument('--interval', type=float, default=1.)
+    p.add_argument('--limit', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == 'simulate':
+        simulate(args.filename, args.directory, args.elements, args.interval, args.limit)
+        return
+
+    if args.simulate:
+        import threading
+        threading.Thread(target=simulate, args=(args.simulate, args.directory, args.elements, args.interval),
+                         daemon=True).start()
+    publish = args.publish or os.path.join(args.directory, 'maps')
+    telemetry = Telemetry([PrintSink(), JsonlSink(os.path.join(publish, 'metrics.jsonl')),
+                           SnapshotSink(publish, npy=True, png=True)], profile_every=0)
+    cfg = ReconConfig(image_size=args.image_size, hidden_features=args.hidden_features,
+                      hidden_layers=args.hidden_layers, lr=args.lr, tv_weight=args.tv_weight, device=args.device)
+    stream = StreamingReconstruction(cfg, args.elements, steps_per_update=args.steps_per_update,
+                                     min_patterns=args.min_patterns, stable_rtol=args.stable_rtol,
+                                     telemetry=telemetry)
+    reason = watch(args.directory, stream, idle_timeout=args.idle_timeout, stop_when_stable=args.stop_when_stable)
+    telemetry.close()
+    print("stopped (%s) after %d patterns, %d steps, maps in %s" % (reason, stream.n_patterns, stream.steps, publish))
+
+
+if __name__ == '__main__':
+    main()
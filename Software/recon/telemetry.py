@@ -0,0 +1,234 @@
+# Asynchronous, rate-limited telemetry for the reconstruction loop
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+class PrintSink:
+    '''Console output in the format of the original script'''
+
+    def write_metrics(self, step, metrics):
+        if 'loss' in metrics:
+            print("Step %d, Total loss %0.6f" % (step, metrics['loss']))
+
+    def write_image(self, step, name, image):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonlSink:
+    '''One JSON record per line: {"step": ..., "time": ..., <metrics>}'''
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a')
+
+    def write_metrics(self, step, metrics):
+        record = {"step": step, "time": time.time()}
+        record.update(metrics)
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def write_image(self, step, name, image):
+        pass
+
+    def close(self):
+        self.file.close()
+
+
+class SnapshotSink:
+    '''Images as <name>_<step>.npy (raw values) and/or .png (min-max normalized 8 bit)'''
+
+    def __init__(self, directory, npy=True, png=True):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.npy = npy
+        self.png = png
+
+    def write_metrics(self, step, metrics):
+        pass
+
+    def write_image(self, step, name, image):
+        path = os.path.join(self.directory, '%s_%06d' % (name, step))
+        if self.npy:
+            np.save(path + '.npy', image)
+        if self.png:
+            lo, hi = image.min(), image.max()
+            scaled = (image - lo) / max(hi - lo, 1e-12) * 255
+            Image.fromarray(scaled.astype(np.uint8)).save(path + '.png')
+
+    def close(self):
+        pass
+
+
+class WandbSink:
+    '''wandb run, mode='offline' writes a local directory that can be synced later with `wandb sync`'''
+
+    def __init__(self, project, name=None, config=None, mode='offline', dir=None):
+        import wandb
+        self.wandb = wandb
+        self.run = wandb.init(project=project, name=name, config=config, mode=mode, dir=dir, reinit=True)
+
+    def write_metrics(self, step, metrics):
+        self.run.log(metrics, step=step)
+
+    def write_image(self, step, name, image):
+        self.run.log({name: self.wandb.Image(image, caption=name)}, step=step)
+
+    def close(self):
+        self.run.finish()
+
+
+class StepTimer:
+    '''
+        Per-phase timing of one training step.
+
+        On cuda the marks are cuda events, resolved later by the writer thread, so timing does not
+        synchronize the training thread. An inactive timer ignores every call.
+    '''
+
+    def __init__(self, device=None, active=True):
+        self.cuda = device is not None and torch.device(device).type == 'cuda'
+        self.active = active
+        self.marks = []
+
+    def now(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def start(self):
+        if self.active:
+            self.marks = [('start', self.now())]
+
+    def mark(self, name):
+        if self.active:
+            self.marks.append((name, self.now()))
+
+    @staticmethod
+    def durations(marks):
+        '''Milliseconds spent in every phase, blocks until the recorded events completed'''
+        if not marks:
+            return {}
+        if isinstance(marks[-1][1], torch.cuda.Event):
+            marks[-1][1].synchronize()
+            return {name: prev.elapsed_time(event) for (_, prev), (name, event) in zip(marks, marks[1:])}
+        return {name: (t - prev) * 1e3 for (_, prev), (name, t) in zip(marks, marks[1:])}
+
+
+class Telemetry:
+    '''
+        Non-blocking telemetry front end.
+
+        Metrics, snapshots and timings are put on a bounded queue and written by a background
+        thread to every sink. Device tensors are enqueued as detached copies and only read back
+        on the writer thread, so the training thread never waits for the host. When the queue is
+        full, or a record of the same kind arrives within min_interval seconds of the last one,
+        the record is dropped and counted instead of blocking.
+
+        Inputs:
+            sinks: objects with write_metrics(step, dict), write_image(step, name, array), close()
+            max_queue: queue capacity in records
+            min_interval: minimum seconds between two records of the same kind
+            profile_every: time the phases of every profile_every-th step, 0 disables timing
+    '''
+
+    def __init__(self, sinks=None, max_queue=64, min_interval=0., profile_every=100):
+        self.sinks = sinks if sinks is not None else [PrintSink()]
+        self.min_interval = min_interval
+        self.profile_every = profile_every
+        self.dropped = 0
+        self.last = {}
+        self.timing_sum = {}
+        self.timing_count = 0
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _accept(self, kind):
+        now = time.monotonic()
+        if self.min_interval and now - self.last.get(kind, -np.inf) < self.min_interval:
+            self.dropped += 1
+            return False
+        self.last[kind] = now
+        return True
+
+    def _put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def log(self, step, **metrics):
+        '''metrics: python numbers or scalar tensors (read back on the writer thread)'''
+        if self._accept('metrics'):
+            metrics = {k: v.detach().clone() if isinstance(v, torch.Tensor) else v for k, v in metrics.items()}
+            self._put(('metrics', step, metrics))
+
+    def snapshot(self, step, name, image):
+        '''image: 2-D array or tensor'''
+        if self._accept('image/' + name):
+            if isinstance(image, torch.Tensor):
+                image = image.detach().clone()
+            self._put(('image', step, name, image))
+
+    def step_timer(self, step, device=None):
+        '''StepTimer for this step, inactive unless step is a profiling step'''
+        return StepTimer(device, active=bool(self.profile_every) and not step % self.profile_every)
+
+    def timing(self, step, timer):
+        if timer.active:
+            self._put(('timing', step, timer.marks))
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    return
+                kind, step = record[0], record[1]
+                if kind == 'metrics':
+                    metrics = {k: v.item() if isinstance(v, torch.Tensor) else v for k, v in record[2].items()}
+                    for sink in self.sinks:
+                        sink.write_metrics(step, metrics)
+                elif kind == 'image':
+                    image = record[3]
+                    if isinstance(image, torch.Tensor):
+                        image = image.float().cpu().numpy()
+                    for sink in self.sinks:
+                        sink.write_image(step, record[2], image)
+                elif kind == 'timing':
+                    durations = StepTimer.durations(record[2])
+                    for name, ms in durations.items():
+                        self.timing_sum[name] = self.timing_sum.get(name, 0.) + ms
+                    self.timing_count += 1
+                    for sink in self.sinks:
+                        sink.write_metrics(step, {'time/' + k: v for k, v in durations.items()})
+            except Exception as e:
+                # a failing sink must never take the training down
+                print("telemetry: %s" % e)
+            finally:
+                self.queue.task_done()
+
+    def timing_summary(self):
+        '''Mean milliseconds per phase over all profiled steps'''
+        return {k: v / self.timing_count for k, v in self.timing_sum.items()} if self.timing_count else {}
+
+    def close(self):
+        '''Flush the queue, stop the writer and close the sinks'''
+        self.queue.put(None)
+        self.thread.join()
+        for sink in self.sinks:
+            sink.close()
+        return self.timing_summary()
@@ -32,6 +32,7 @@ import time
 from torch.autograd import Variable
 
 from model import Siren
+from dataset import load_mat
 
 def get_mgrid(sidelen, dim=2):
     '''Generates a flattened grid of (x,y,...) coordinates in a range of -1 to 1.
@@ -92,23 +93,23 @@ def gradient_loss(gen_frames, gt_frames, alpha=1):
     def gradient(x):
         # idea from tf.image.image_gradients(image)
         # https://github.com/tensorflow/tensorflow/blob/r2.1/tensorflow/python/ops/image_ops_impl.py#L3441-L3512
-        # x: (b,c,h,w), float32 or float64
-        # dx, dy: (b,c,h,w)
+        # x: (h,w) or a stack (...,h,w), float32 or float64
+        # dx, dy: same shape as x
 
         h_x = x.size()[-2]
         w_x = x.size()[-1]
         # gradient step=1
         left = x
-        right = F.pad(x, [0, 1,0,0])[:, 1:]
+        right = F.pad(x, [0, 1,0,0])[..., 1:]
         top = x
-        bottom = F.pad(x, [0,0,0, 1])[1:, :]
+        bottom = F.pad(x, [0,0,0, 1])[..., 1:, :]
 
         # dx, dy = torch.abs(right - left), torch.abs(bottom - top)
         dx, dy = right - left, bottom - top
         # dx will always have zeros in the last column, right-left
         # dy will always have zeros in the last row,    bottom-top
-        dx[:, -1] = 0
-        dy[-1, :] = 0
+        dx[..., -1] = 0
+        dy[..., -1, :] = 0
 
         return dx, dy
 
@@ -132,16 +133,16 @@ def cal_gradient(x):
     w_x = x.size()[-1]
     # gradient step=1
     left = x
-    right = F.pad(x, [0, 1,0,0])[:, 1:]
+    right = F.pad(x, [0, 1,0,0])[..., 1:]
     top = x
-    bottom = F.pad(x, [0,0,0, 1])[1:, :]
+    bottom = F.pad(x, [0,0,0, 1])[..., 1:, :]
 
     # dx, dy = torch.abs(right - left), torch.abs(bottom - top)
     dx, dy = right - left, bottom - top
     # dx will always have zeros in the last column, right-left
     # dy will always have zeros in the last row,    bottom-top
-    dx[:, -1] = 0
-    dy[-1, :] = 0
+    dx[..., -1] = 0
+    dy[..., -1, :] = 0
 
     return dx, dy
 
@@ -175,11 +176,10 @@ class CompressiveImaging(Dataset):
         return self.coords, self.ground_truth, self.compressed, self.Gx, self.Gy
 
 def load_data(filename, sampling_ratio, image_size, noise_level=0):
+    mat = load_mat(filename+'_size_' + str(image_size) + "_sampling_" + str(sampling_ratio) + '.mat')
     # load measurement matrix
-    A = loadmat(filename+'_size_' + str(image_size) + "_sampling_" + str(sampling_ratio) + '.mat')['h']
-    A = torch.from_numpy(A).to(torch.float32).T
-    img = loadmat(filename+'_size_' + str(image_size) + "_sampling_" + str(sampling_ratio) + '.mat')['z']
-    img = Image.fromarray(img)
+    A = torch.tensor(mat['h'], dtype=torch.float32).T
+    img = Image.fromarray(np.array(mat['z']))
     transform = Compose([
         Resize(image_size),
         ToTensor(),
@@ -195,6 +195,20 @@ def load_data(filename, sampling_ratio, image_size, noise_level=0):
     model_input, ground_truth, compressed, Gx, Gy,A = model_input.cuda(), ground_truth.cuda(), compressed.cuda(), Gx.cuda(), Gy.cuda(), A.cuda()
     return model_input, ground_truth, compressed, Gx, Gy,A
 
+def load_real_data(filename, elements):
+    '''
+        Load an experimental dataset (filename without .mat), arrays are memory-mapped from the
+        dataset cache, see dataset.MatDataset
+
+        Outputs:
+            Patterns: (n_pixels, n_patterns) illumination patterns
+            xrf: (n_patterns, n_elements) XRF amounts, columns ordered as elements
+            TXM: raw TXM image
+    '''
+    mat = load_mat(filename + '.mat')
+    xrf = np.stack([mat['XRF_amount_' + element].reshape(-1) for element in elements], 1)
+    return mat['Patterns'], xrf, mat['TXM']
+
 def normalize(x, fullnormalize=False):
     '''
         Normalize input to lie between 0, 1.